@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+"""
+Generate a synthetic makefile tree of a given size and shape, for benchmarks.
+
+usage: genmakefile.py [options] DIR
+
+The targets are in layers: each depends on its source file and on --fanin targets in the next
+layer, and 'all' depends on the first layer. Options:
+
+--targets N       the number of targets, in this makefile and its sub-makes together
+--depth N         the number of layers
+--fanin N         the number of targets in the next layer each target depends on
+--pattern-rules N make targets with N pattern rules, instead of explicit rules
+--vpath-dirs N    put the sources in N directories searched with VPATH
+--includes N      put the rules in N makefiles included by the main one
+--submakes N      split the targets between this makefile and N recursive sub-makes
+
+Every target is made with the native touch command, so that a build runs no processes other
+than pymake's own and a second build has nothing to do.
+"""
+
+import os, sys
+from optparse import OptionParser
+
+TOUCH = '%pymake.builtins touch $@'
+
+def _write(path, lines):
+    fd = open(path, 'w')
+    fd.write('\n'.join(lines))
+    fd.write('\n')
+    fd.close()
+
+def _generatedir(dir, targets, depth, fanin, patternrules, vpathdirs, includes):
+    """
+    Generate a makefile without sub-makes. Returns (targets, edges).
+    """
+    depth = max(1, min(depth, targets))
+    width = (targets + depth - 1) // depth
+
+    def name(i, ext):
+        if patternrules:
+            return 't%i.%s%i' % (i, ext, i % patternrules)
+        return 't%i.%s' % (i, ext)
+
+    srcdirs = ['src%i' % d for d in xrange(vpathdirs)]
+    for d in srcdirs:
+        os.mkdir(os.path.join(dir, d))
+
+    rules = []
+    edges = 0
+    for i in xrange(targets):
+        layer, pos = divmod(i, width)
+
+        source = name(i, 'c')
+        srcdir = vpathdirs and srcdirs[i % vpathdirs] or ''
+        open(os.path.join(dir, srcdir, source), 'w').close()
+
+        base = (layer + 1) * width
+        nextwidth = min(width, targets - base)
+        deps = [source]
+        if nextwidth > 0:
+            deps.extend(name(base + d, 'o') for d in
+                        sorted(set((pos * 7 + k * 13) % nextwidth for k in xrange(fanin))))
+        edges += len(deps)
+
+        rules.append('%s: %s' % (name(i, 'o'), ' '.join(deps)))
+        if not patternrules:
+            rules.append('\t' + TOUCH)
+
+    main = ['all: %s' % ' '.join(name(i, 'o') for i in xrange(min(width, targets)))]
+    edges += min(width, targets)
+
+    if vpathdirs:
+        main.append('VPATH = %s' % ' '.join(srcdirs))
+
+    for k in xrange(patternrules):
+        main.append('%%.o%i: %%.c%i' % (k, k))
+        main.append('\t' + TOUCH)
+
+    if includes:
+        step = 1 + (not patternrules)
+        for j in xrange(includes):
+            fragment = 'inc%i.mk' % j
+            _write(os.path.join(dir, fragment),
+                   [l for i in xrange(j, targets, includes) for l in rules[i * step:(i + 1) * step]])
+            main.append('include %s' % fragment)
+    else:
+        main.extend(rules)
+
+    _write(os.path.join(dir, 'Makefile'), main)
+    return targets, edges
+
+def generate(dir, targets=1000, depth=5, fanin=2, patternrules=0, vpathdirs=0, includes=0,
+             submakes=0):
+    """
+    Generate a makefile tree in the existing, empty directory `dir`. Returns
+    (number of targets, number of dependency edges), counting sub-makes.
+    """
+    if not submakes:
+        return _generatedir(dir, targets, depth, fanin, patternrules, vpathdirs, includes)
+
+    share = max(1, targets // (submakes + 1))
+    subdir = os.path.join(dir, 'top')
+    os.mkdir(subdir)
+    total, edges = _generatedir(subdir, share, depth, fanin, patternrules, vpathdirs, includes)
+
+    subs = ['sub%i' % j for j in xrange(submakes)]
+    for sub in subs:
+        subdir = os.path.join(dir, sub)
+        os.mkdir(subdir)
+        t, e = _generatedir(subdir, share, depth, fanin, patternrules, vpathdirs, includes)
+        total += t
+        edges += e
+
+    _write(os.path.join(dir, 'Makefile'),
+           ['all: top %s' % ' '.join(subs),
+            '.PHONY: all top %s' % ' '.join(subs),
+            'top %s:' % ' '.join(subs),
+            '\t$(MAKE) -C $@'])
+    return total, edges + submakes + 1
+
+def main(args):
+    op = OptionParser(usage='%prog [options] DIR')
+    op.add_option('--targets', type='int', dest='targets', default=1000)
+    op.add_option('--depth', type='int', dest='depth', default=5)
+    op.add_option('--fanin', type='int', dest='fanin', default=2)
+    op.add_option('--pattern-rules', type='int', dest='patternrules', default=0)
+    op.add_option('--vpath-dirs', type='int', dest='vpathdirs', default=0)
+    op.add_option('--includes', type='int', dest='includes', default=0)
+    op.add_option('--submakes', type='int', dest='submakes', default=0)
+    options, args = op.parse_args(args)
+
+    if len(args) != 1:
+        op.error("a directory is required")
+
+    dir, = args
+    if not os.path.exists(dir):
+        os.makedirs(dir)
+
+    targets, edges = generate(dir, options.targets, options.depth, options.fanin,
+                              options.patternrules, options.vpathdirs, options.includes,
+                              options.submakes)
+    print "%s: %i targets, %i edges" % (dir, targets, edges)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+"""
+Report how much memory the strings naming targets and prerequisites take up in a large
+generated dependency graph, compared to keeping a separate copy of each name for every
+reference to it.
+
+Usage: memreport.py [objects [headers-per-object]]
+"""
+
+import os, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import pymake.data, pymake.parser
+
+def makegraph(objects, headers):
+    lines = ['all: %s' % ' '.join('obj/file%d.o' % i for i in xrange(objects))]
+    for i in xrange(objects):
+        deps = ' '.join('include/header%d.h' % ((i + j) % (objects // 4 + 1))
+                        for j in xrange(headers))
+        lines.append('obj/file%d.o: src/file%d.c %s' % (i, i, deps))
+    return '\n'.join(lines) + '\n'
+
+def main(args):
+    objects = len(args) > 0 and int(args[0]) or 5000
+    headers = len(args) > 1 and int(args[1]) or 30
+
+    stmts = pymake.parser.parsestring(makegraph(objects, headers), 'memreport.mk')
+    m = pymake.data.Makefile(workdir=os.getcwd())
+    stmts.execute(m)
+    m.finishparsing()
+
+    refs = []
+    for t in m._targets.itervalues():
+        refs.append(t.target)
+        for r in t.rules:
+            refs.extend(r.prerequisites)
+
+    copies = sum(sys.getsizeof(s) for s in refs)
+    objs = dict((id(s), s) for s in refs)
+    shared = sum(sys.getsizeof(s) for s in objs.itervalues())
+
+    print "targets:              %d" % len(m._targets)
+    print "name references:      %d" % len(refs)
+    print "distinct names:       %d" % len(set(refs))
+    print "string objects:       %d" % len(objs)
+    print "bytes, one per ref:   %d" % copies
+    print "bytes, actual:        %d" % shared
+    print "bytes saved:          %d (%.1f%%)" % (copies - shared, 100.0 * (copies - shared) / copies)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
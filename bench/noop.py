@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+"""
+Measure the overhead of scheduling targets: make a synthetic makefile of targets which have no
+commands, so that nothing but pymake's own bookkeeping is timed, and report the time taken per
+dependency edge.
+
+usage: noop.py [-n targets] [--fanin N] [--width N] [-j jobs]
+
+The targets are in layers of --width targets, each depending on --fanin targets in the next
+layer. A single wide layer, with --width equal to -n, stresses the queue of deferred callbacks.
+"""
+
+import os, sys, time, tempfile, shutil, gc
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import pymake.data, pymake.parser, pymake.process
+
+def makefiletext(targets, fanin, width):
+    """
+    Targets t0 ... t<targets-1> in layers of `width`, each depending on `fanin` targets in the
+    next layer. 'all' depends on the first layer. Returns (makefile text, number of edges).
+    """
+    lines = ['all: %s' % ' '.join('t%i' % i for i in xrange(min(width, targets)))]
+    edges = min(width, targets)
+    for i in xrange(targets):
+        layer, pos = divmod(i, width)
+        base = (layer + 1) * width
+        deps = [base + (pos * 7 + k * 13) % width for k in xrange(fanin)]
+        deps = ['t%i' % d for d in sorted(set(deps)) if d < targets]
+        edges += len(deps)
+        lines.append('t%i: %s' % (i, ' '.join(deps)))
+    return '\n'.join(lines) + '\n', edges
+
+class _Finished(Exception):
+    pass
+
+def _finished(error, didanything):
+    if error:
+        raise Exception("make failed")
+    raise _Finished()
+
+def run(text, workdir, jobs):
+    """
+    Parse `text` and make its default target. Returns (parse seconds, make seconds).
+    """
+    start = time.time()
+    makefile = pymake.data.Makefile(workdir=workdir, env={},
+                                    context=pymake.process.getcontext(jobs))
+    pymake.parser.parsestring(text, 'noop.mk').execute(makefile)
+    makefile.finishparsing()
+    parsed = time.time()
+
+    try:
+        makefile.gettarget('all').make(makefile, [], cb=_finished)
+        pymake.process.ParallelContext.spin()
+    except _Finished:
+        pass
+
+    return parsed - start, time.time() - parsed
+
+def main(args):
+    op = OptionParser()
+    op.add_option('-n', '--targets', type='int', dest='targets', default=100000)
+    op.add_option('--fanin', type='int', dest='fanin', default=4)
+    op.add_option('--width', type='int', dest='width', default=1000)
+    op.add_option('-j', '--jobs', type='int', dest='jobs', default=1)
+    options, args = op.parse_args(args)
+
+    gc.disable()
+    text, edges = makefiletext(options.targets, options.fanin, options.width)
+
+    workdir = tempfile.mkdtemp()
+    try:
+        parsetime, maketime = run(text, workdir, options.jobs)
+    finally:
+        shutil.rmtree(workdir)
+
+    print "targets: %i  edges: %i  jobs: %i" % (options.targets, edges, options.jobs)
+    print "parse: %.2fs  make: %.2fs  (%.2f us per target, %.2f us per edge)" % (
+        parsetime, maketime, maketime / options.targets * 1e6, maketime / edges * 1e6)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
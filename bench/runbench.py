@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+"""
+Time pymake on synthetic makefiles of increasing size, to catch costs which grow faster than
+the makefiles do.
+
+usage: runbench.py [-o results.json] [--sizes 1000,2000,4000] [-j jobs] [--repeat N] [preset ...]
+
+Each preset is a shape of makefile from genmakefile.py; by default all of them are run. For
+each preset and size, a fresh process generates the makefile tree and builds it twice. The
+phases of each build are timed separately:
+
+parse     reading the makefiles, up to Makefile.finishparsing
+resolve   resolving every target reachable from the default target: vpath and implicit rules
+execute   making the default target, including any sub-makes
+
+The first build makes everything and the second finds everything up to date. The growth of
+each phase from one size to the next is reported as an exponent: 1.0 is linear, and 2.0 is
+quadratic. With --repeat, each size is measured several times and the fastest time of each
+phase is kept. With -o, the results are also written as JSON.
+"""
+
+import os, sys, time, json, math, tempfile, shutil, subprocess, gc
+from optparse import OptionParser
+
+benchdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(benchdir, '..'))
+
+import genmakefile
+
+# Keyword arguments for genmakefile.generate. 'width' sets the depth to the size divided by it.
+PRESETS = {
+    'layered': dict(depth=10, fanin=4),
+    'wide': dict(depth=1, fanin=0),
+    'deep': dict(width=4, fanin=2),
+    'patterns': dict(depth=5, fanin=2, patternrules=20, vpathdirs=10),
+    'includes': dict(depth=5, fanin=2, includes=50),
+    'recursive': dict(depth=5, fanin=2, submakes=10),
+}
+
+PHASES = ('parse', 'resolve', 'execute')
+
+class _Finished(Exception):
+    def __init__(self, error):
+        Exception.__init__(self)
+        self.error = error
+
+def _finished(error, didanything):
+    raise _Finished(error)
+
+def _resolveall(makefile, target):
+    """
+    Resolve `target` and everything it depends on, as making it would.
+    """
+    seen = set()
+    stack = [target]
+    while len(stack):
+        t = stack.pop()
+        if t.nodeid in seen:
+            continue
+        seen.add(t.nodeid)
+
+        t.resolvedeps(makefile, [], [], False)
+        for r in t.rules:
+            stack.extend(makefile.graph.ruletargets(r))
+
+def _build(dir, jobs):
+    """
+    Build the default target of the makefile in `dir`, returning {phase: seconds}.
+    """
+    import pymake.data, pymake.process, pymake.command, pymake.fscache
+
+    # Forget the modification times of the last build
+    pymake.fscache.reset()
+
+    # Sub-makes get -j from MAKEFLAGS, as they would from make.py
+    makeflags = ''
+    if jobs != 1:
+        makeflags = '-j%i' % jobs
+
+    times = {}
+    start = time.time()
+    makefile = pymake.data.Makefile(workdir=dir, env=dict(os.environ), makeflags=makeflags,
+                                    make='%s %s' % (sys.executable.replace('\\', '/'), pymake.command.makepypath.replace('\\', '/')),
+                                    context=pymake.process.getcontext(jobs))
+    makefile.include('Makefile')
+    makefile.finishparsing()
+    times['parse'] = time.time() - start
+
+    start = time.time()
+    target = makefile.gettarget(makefile.defaulttarget)
+    _resolveall(makefile, target)
+    times['resolve'] = time.time() - start
+
+    start = time.time()
+    try:
+        target.make(makefile, [], cb=_finished)
+        pymake.process.ParallelContext.spin()
+    except _Finished, e:
+        if e.error:
+            raise Exception("building %s failed" % dir)
+    times['execute'] = time.time() - start
+
+    return times
+
+def measure(preset, size, jobs):
+    """
+    Generate the makefile tree for `preset` at `size` and build it twice. Run this in a fresh
+    process.
+    """
+    gc.disable()
+
+    dir = tempfile.mkdtemp()
+    try:
+        params = dict(PRESETS[preset])
+        if 'width' in params:
+            params['depth'] = max(1, size // params.pop('width'))
+        targets, edges = genmakefile.generate(dir, targets=size, **params)
+        os.chdir(dir)
+        full = _build(dir, jobs)
+        noop = _build(dir, jobs)
+    finally:
+        os.chdir(benchdir)
+        shutil.rmtree(dir)
+
+    return {'preset': preset, 'size': size, 'jobs': jobs,
+            'targets': targets, 'edges': edges,
+            'full': full, 'noop': noop}
+
+def _exponents(small, large):
+    """
+    For each phase, the exponent k such that time grows with the size of the graph ** k
+    between two results. The size is the number of targets and edges.
+    """
+    growth = float(large['targets'] + large['edges']) / (small['targets'] + small['edges'])
+    r = {}
+    for build in ('full', 'noop'):
+        for phase in PHASES:
+            t1, t2 = small[build][phase], large[build][phase]
+            if t1 <= 0.001 or t2 <= 0.001:
+                continue
+            r['%s-%s' % (build, phase)] = math.log(t2 / t1) / math.log(growth)
+    return r
+
+def main(args):
+    op = OptionParser(usage='%prog [options] [preset ...]')
+    op.add_option('-o', '--output', dest='output', default=None)
+    op.add_option('--sizes', dest='sizes', default='1000,2000,4000')
+    op.add_option('-j', '--jobs', type='int', dest='jobs', default=1)
+    op.add_option('--repeat', type='int', dest='repeat', default=1)
+    op.add_option('--one', dest='one', default=None,
+                  help="internal: measure PRESET:SIZE and print the result as JSON")
+    options, args = op.parse_args(args)
+
+    if options.one is not None:
+        preset, size = options.one.split(':')
+        print json.dumps(measure(preset, int(size), options.jobs))
+        return
+
+    presets = args or sorted(PRESETS.iterkeys())
+    for p in presets:
+        if p not in PRESETS:
+            op.error("unknown preset '%s': choose from %s" % (p, ', '.join(sorted(PRESETS))))
+    sizes = [int(s) for s in options.sizes.split(',')]
+
+    results = []
+    print "%-10s %7s %8s   %-27s %-27s" % ('preset', 'targets', 'edges', 'full build (s)', 'no-op build (s)')
+    print "%-10s %7s %8s   %8s %8s %9s %8s %8s %9s" % ('', '', '', 'parse', 'resolve', 'execute', 'parse', 'resolve', 'execute')
+    for preset in presets:
+        previous = None
+        for size in sizes:
+            result = None
+            for i in xrange(options.repeat):
+                p = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--one', '%s:%i' % (preset, size),
+                                      '-j', str(options.jobs)],
+                                     stdout=subprocess.PIPE)
+                output, err = p.communicate()
+                if p.returncode != 0:
+                    print >>sys.stderr, "runbench.py: %s at size %i failed" % (preset, size)
+                    sys.exit(1)
+
+                r = json.loads(output.splitlines()[-1])
+                if result is None:
+                    result = r
+                else:
+                    for build in ('full', 'noop'):
+                        for phase in PHASES:
+                            result[build][phase] = min(result[build][phase], r[build][phase])
+
+            if previous is not None:
+                result['exponents'] = _exponents(previous, result)
+            results.append(result)
+            previous = result
+
+            print "%-10s %7i %8i   %8.3f %8.3f %9.3f %8.3f %8.3f %9.3f" % (
+                preset, result['targets'], result['edges'],
+                result['full']['parse'], result['full']['resolve'], result['full']['execute'],
+                result['noop']['parse'], result['noop']['resolve'], result['noop']['execute'])
+
+            superlinear = sorted(k for k, v in result.get('exponents', {}).iteritems() if v > 1.3)
+            if superlinear:
+                print "%-10s %7s %8s   grows faster than linearly: %s" % ('', '', '', ', '.join(superlinear))
+            sys.stdout.flush()
+
+    if options.output is not None:
+        fd = open(options.output, 'w')
+        json.dump({'python': sys.version.split()[0],
+                   'time': time.time(),
+                   'jobs': options.jobs,
+                   'results': results}, fd, indent=1, sort_keys=True)
+        fd.write('\n')
+        fd.close()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -7,13 +7,19 @@ A drop-in or mostly drop-in replacement for GNU make.
 """
 
 import sys, os
-import pymake.command, pymake.process
+import pymake.command, pymake.process, pymake.daemon
 
 import gc
 
 if __name__ == '__main__':
   gc.disable()
 
+  daemonpath = os.environ.get('PYMAKE_DAEMON', None)
+  if daemonpath:
+    code = pymake.daemon.request(daemonpath, sys.argv[1:], os.environ, os.getcwd())
+    if code is not None:
+      sys.exit(code)
+
   pymake.command.main(sys.argv[1:], os.environ, os.getcwd(), cb=sys.exit)
   pymake.process.ParallelContext.spin()
   assert False, "Not reached"
@@ -0,0 +1,165 @@
+"""
+A local cache of the files made by rules.
+
+An entry is keyed on a hash of the expanded commands of the rule and of the contents of its
+prerequisites, and holds a copy of the target file made by running the commands. When a target
+needs remaking and the cache has an entry for the same key, the file is copied out of the
+cache instead of running the commands. Commands whose only effect is on their target are the
+only ones which should be cached, so only the targets a makefile lists as prerequisites of the
+special target .PYMAKE_CACHEABLE are.
+
+Entries are stored as DIR/xx/yyyy..., named by their key. They are written to a temporary
+file in the cache and renamed into place, so makes running concurrently, in this process or
+others, never see partial entries. Restoring an entry updates its modification time; when the
+cache grows beyond its size limit, the entries used least recently are removed.
+
+All of the makes running in this process share one OutputCache object per directory.
+"""
+
+import os, shutil, logging, errno
+
+_log = logging.getLogger('pymake.buildcache')
+
+_caches = {}
+
+def getcache(path, maxsize):
+    """
+    Get the shared OutputCache for the directory `path`, which should be absolute.
+    """
+    cache = _caches.get(path, None)
+    if cache is None:
+        cache = OutputCache(path, maxsize)
+        _caches[path] = cache
+    return cache
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+def _copy(src, dest):
+    """
+    Copy the file `src`, with its permissions, to a temporary file and rename it to `dest`.
+    """
+    tmp = '%s.tmp%i' % (dest, os.getpid())
+    try:
+        shutil.copyfile(src, tmp)
+        shutil.copymode(src, tmp)
+        if os.name == 'nt' and os.path.exists(dest):
+            os.remove(dest)
+        os.rename(tmp, dest)
+    except (IOError, OSError):
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+class OutputCache(object):
+    # When the cache is too large, remove entries until it is this fraction of its limit, so
+    # that each insertion doesn't scan the cache.
+    EVICTRATIO = 0.9
+
+    def __init__(self, path, maxsize):
+        self.path = path
+        self.maxsize = maxsize
+        self._size = None # total size of the entries, once scanned
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+        _makedirs(path)
+
+    def _entrypath(self, key):
+        return os.path.join(self.path, key[:2], key[2:])
+
+    def restore(self, key, dest):
+        """
+        Copy the entry for `key` to the file `dest`. Returns False if there is no such entry;
+        the miss is counted if the commands then make a file to store.
+        """
+        entry = self._entrypath(key)
+        try:
+            _copy(entry, dest)
+        except (IOError, OSError), e:
+            if os.path.exists(entry):
+                _log.warning("Couldn't restore '%s' from the output cache: %s", dest, e)
+            return False
+
+        try:
+            os.utime(entry, None)
+        except OSError:
+            # Evicted by another make
+            pass
+
+        self.hits += 1
+        return True
+
+    def store(self, key, src):
+        """
+        Add the file `src`, which was made by running commands, to the cache as the entry for
+        `key`.
+        """
+        if not os.path.isfile(src):
+            _log.debug("Not caching '%s': not a file", src)
+            return
+
+        self.misses += 1
+
+        entry = self._entrypath(key)
+        if os.path.exists(entry):
+            return
+
+        try:
+            _makedirs(os.path.dirname(entry))
+            _copy(src, entry)
+        except (IOError, OSError), e:
+            _log.warning("Couldn't add '%s' to the output cache: %s", src, e)
+            return
+
+        self.stores += 1
+        if self._size is None:
+            self._size = sum(size for mtime, size, path in self._entries())
+        else:
+            self._size += os.path.getsize(entry)
+
+        if self._size > self.maxsize:
+            self._evict()
+
+    def _entries(self):
+        """
+        Yield (mtime, size, path) for each entry in the cache.
+        """
+        for dir in os.listdir(self.path):
+            dirpath = os.path.join(self.path, dir)
+            if not os.path.isdir(dirpath):
+                continue
+            for leaf in os.listdir(dirpath):
+                if '.' in leaf:
+                    # a temporary file being copied into place
+                    continue
+                path = os.path.join(dirpath, leaf)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield st.st_mtime, st.st_size, path
+
+    def _evict(self):
+        entries = list(self._entries())
+        entries.sort()
+
+        size = sum(e[1] for e in entries)
+        target = self.maxsize * self.EVICTRATIO
+        for mtime, esize, path in entries:
+            if size <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= esize
+
+        _log.info("Evicted output cache entries: %s is now %i bytes", self.path, size)
+        self._size = size
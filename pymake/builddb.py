@@ -0,0 +1,223 @@
+"""
+A database of per-target build state which is kept between builds.
+
+Each record describes one target, named by its absolute path, and holds fields such as the wall
+time its commands ran for, not counting time spent waiting for a job slot ('duration'), their
+exit status ('status'), and when they finished ('time'). Records for files whose contents have been hashed hold the hash ('hash') and the
+modification time and size of the file when it was hashed ('hashstamp'). Updates are appended
+to the database file as JSON lines, each written with a single write to a file opened for
+appending, so makes running in other processes can share the file.
+When the file is read, later lines for a target update the fields of earlier ones.
+
+Each process holds a shared lock on the file while it has it open for appending. The file is
+rewritten without superseded lines only by a process which can take an exclusive lock, when no
+other process is using it. Locking requires fcntl, so the file is never compacted without it.
+
+All of the makes running in this process share one BuildDB object per file.
+"""
+
+import os, stat, json, logging, hashlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+_log = logging.getLogger('pymake.builddb')
+
+_databases = {}
+
+def getdatabase(path):
+    """
+    Get the shared BuildDB for `path`, which should be absolute.
+    """
+    db = _databases.get(path, None)
+    if db is None:
+        db = BuildDB(path)
+        _databases[path] = db
+    return db
+
+class BuildDB(object):
+    # Rewrite the file without superseded lines when it has this many times more lines than
+    # there are targets.
+    COMPACTRATIO = 4
+
+    def __init__(self, path):
+        self.path = path
+        self._records = {} # target path -> {field: value}
+        self._session = set() # target paths recorded by this process
+        self._durationtotal = 0.0
+        self._durationcount = 0
+
+        self._fd = self._open()
+
+        lines = self._load()
+        if lines > 1000 and lines > self.COMPACTRATIO * len(self._records):
+            self._compact()
+
+    def _open(self):
+        """
+        Open the file for appending and take a shared lock on it.
+        """
+        while True:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+            if fcntl is None:
+                return fd
+
+            fcntl.flock(fd, fcntl.LOCK_SH)
+
+            # The file may have been replaced by a compaction while we waited for the lock
+            try:
+                if os.path.samestat(os.fstat(fd), os.stat(self.path)):
+                    return fd
+            except OSError:
+                pass
+            os.close(fd)
+
+    def _load(self):
+        try:
+            fd = open(self.path, 'rb')
+        except IOError:
+            return 0
+
+        lines = 0
+        for line in fd:
+            lines += 1
+            try:
+                target, fields = json.loads(line)
+            except ValueError:
+                # A partially-written line from a make which was interrupted
+                _log.debug("%s: ignoring malformed line %i", self.path, lines)
+                continue
+            self._update(str(target), fields)
+        fd.close()
+
+        return lines
+
+    def _compact(self):
+        """
+        Rewrite the file without superseded lines, unless another process has it open.
+        """
+        if fcntl is None:
+            return
+
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            _log.debug("%s: not compacting, another make is using it", self.path)
+            return
+
+        # Read the file again, with any lines appended since it was loaded
+        self._records = {}
+        self._durationtotal = 0.0
+        self._durationcount = 0
+        self._load()
+
+        tmppath = '%s.tmp%i' % (self.path, os.getpid())
+        fd = open(tmppath, 'wb')
+        for target, record in self._records.iteritems():
+            fd.write(json.dumps([target, record]) + '\n')
+        fd.close()
+        os.rename(tmppath, self.path)
+
+        # Other processes waiting for the old file notice that it was replaced
+        oldfd = self._fd
+        self._fd = self._open()
+        os.close(oldfd)
+
+    def _update(self, target, fields):
+        record = self._records.setdefault(target, {})
+
+        olddur = record.get('duration', None)
+        if olddur is not None:
+            self._durationtotal -= olddur
+            self._durationcount -= 1
+
+        record.update(fields)
+
+        newdur = record.get('duration', None)
+        if newdur is not None:
+            self._durationtotal += newdur
+            self._durationcount += 1
+
+    def get(self, target):
+        """
+        Get the record for `target` as a dict of fields, or None. It must not be modified.
+        """
+        return self._records.get(target, None)
+
+    def record(self, target, **fields):
+        """
+        Update the fields of the record for `target` and save them.
+        """
+        self._save(target, fields)
+        self._session.add(target)
+
+    def _save(self, target, fields):
+        self._update(target, fields)
+        os.write(self._fd, json.dumps([target, fields]) + '\n')
+
+    def recordbuild(self, target, duration, status, time):
+        self.record(target, duration=duration, status=status, time=time)
+
+    def filehash(self, path):
+        """
+        Get a hash of the contents of the file at `path`, or None if it doesn't exist or isn't
+        a regular file. The hash is only recomputed when the modification time or size of the
+        file changes.
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+
+        if not stat.S_ISREG(st.st_mode):
+            return None
+
+        stamp = [st.st_mtime, st.st_size]
+        record = self._records.get(path, None)
+        if record is not None and record.get('hashstamp', None) == stamp:
+            return record['hash']
+
+        h = hashlib.sha1()
+        try:
+            fd = open(path, 'rb')
+            try:
+                while True:
+                    chunk = fd.read(65536)
+                    if not chunk:
+                        break
+                    h.update(chunk)
+            finally:
+                fd.close()
+        except (IOError, OSError), e:
+            _log.info("Couldn't hash '%s': %s", path, e)
+            return None
+
+        digest = h.hexdigest()
+        # not recorded in the session: hashing a file doesn't mean this process remade it
+        self._save(path, {'hash': digest, 'hashstamp': stamp})
+        return digest
+
+    def estimateduration(self, target):
+        """
+        Estimate how long remaking `target` takes: the last duration recorded for it, or the
+        mean of all recorded durations. Returns None if nothing has been recorded.
+        """
+        record = self._records.get(target, None)
+        if record is not None and 'duration' in record:
+            return record['duration']
+
+        if self._durationcount:
+            return self._durationtotal / self._durationcount
+
+        return None
+
+    def slowest(self, count):
+        """
+        The `count` slowest targets remade by this process, as a list of (duration, target).
+        """
+        l = [(self._records[t]['duration'], t) for t in self._session
+             if 'duration' in self._records[t]]
+        l.sort(reverse=True)
+        return l[:count]
@@ -8,7 +8,7 @@ except when a submake specifies -j1 when the parent make is building in parallel
 
 import os, subprocess, sys, logging, time, traceback, re
 from optparse import OptionParser
-import data, parserdata, process, util
+import data, parserdata, process, util, builddb, buildcache, fscache, inotify, snapshot
 
 # TODO: If this ever goes from relocatable package to system-installed, this may need to be
 # a configured-in path.
@@ -72,8 +72,16 @@ DEALINGS IN THE SOFTWARE."""
 
 _log = logging.getLogger('pymake.execution')
 
+# The build-state database used by options which need one, if --state-db isn't given
+_defaultstatedb = '.pymake-state.db'
+
+# A cache of parsed makefiles to reuse for later makes with the same command line,
+# environment and directory, set by long-running processes such as the build server. See
+# daemon.MakefileCache.
+makefilecache = None
+
 class _MakeContext(object):
-    def __init__(self, makeflags, makelevel, workdir, context, env, targets, options, ostmts, overrides, cb):
+    def __init__(self, makeflags, makelevel, workdir, context, env, targets, options, ostmts, overrides, statedb, outputcache, cachekey, snapshotpath, watcher, cb):
         self.makeflags = makeflags
         self.makelevel = makelevel
 
@@ -84,8 +92,19 @@ class _MakeContext(object):
         self.options = options
         self.ostmts = ostmts
         self.overrides = overrides
+        self.statedb = statedb
+        self.outputcache = outputcache
         self.cb = cb
 
+        # The command line, environment and working directory, which identify makefiles
+        # parsed by earlier makes
+        self.cachekey = cachekey
+        self.cachestamps = None
+        self.snapshotpath = snapshotpath
+
+        self.watcher = watcher
+        self.building = None # the targets reset for this build, or None for all of them
+
         self.restarts = 0
 
         self.remakecb(True)
@@ -97,9 +116,19 @@ class _MakeContext(object):
             return
 
         if remade:
+            if self.restarts == 0 and self.reuseparsed():
+                self.restarts += 1
+                try:
+                    self.makefile.remakemakefiles(self.remakecb)
+                except util.MakeError, e:
+                    print e
+                    self.context.defer(self.cb, 2)
+                return
+
             if self.restarts > 0:
                 _log.info("make.py[%i]: Restarting makefile parsing", self.makelevel)
 
+            self.building = None
             self.makefile = data.Makefile(restarts=self.restarts,
                                           make='%s %s' % (sys.executable.replace('\\', '/'), makepypath.replace('\\', '/')),
                                           makeflags=self.makeflags,
@@ -111,7 +140,11 @@ class _MakeContext(object):
                                           targets=self.targets,
                                           keepgoing=self.options.keepgoing,
                                           silent=self.options.silent,
-                                          justprint=self.options.justprint)
+                                          justprint=self.options.justprint,
+                                          statedb=self.statedb,
+                                          contenthash=self.options.contenthash,
+                                          commandsignatures=self.options.commandsignatures,
+                                          outputcache=self.outputcache)
 
             self.restarts += 1
 
@@ -120,6 +153,10 @@ class _MakeContext(object):
                 for f in self.options.makefiles:
                     self.makefile.include(f)
                 self.makefile.finishparsing()
+                if makefilecache is not None:
+                    self.cachestamps = makefilecache.stamp(self.makefile)
+                if self.snapshotpath is not None and self.restarts == 1:
+                    snapshot.save(self.snapshotpath, self.cachekey, self.makefile)
                 self.makefile.remakemakefiles(self.remakecb)
             except util.MakeError, e:
                 print e
@@ -127,6 +164,34 @@ class _MakeContext(object):
 
             return
 
+        self.maketargets()
+
+    def reuseparsed(self):
+        """
+        Try to reuse makefiles parsed by an earlier make, kept by the build server or in a
+        snapshot, instead of parsing them.
+        """
+        if makefilecache is not None:
+            cached = makefilecache.checkout(self.cachekey)
+            if cached is not None:
+                _log.info("make.py[%i]: Reusing makefiles parsed by an earlier make", self.makelevel)
+                self.makefile, self.cachestamps = cached
+                self.makefile.resetbuildstate()
+                return True
+
+        if self.snapshotpath is not None:
+            makefile = snapshot.load(self.snapshotpath, self.cachekey)
+            if makefile is not None:
+                _log.info("make.py[%i]: Using makefile snapshot '%s'", self.makelevel, self.snapshotpath)
+                makefile.attach(self.env, self.context, self.statedb, self.outputcache)
+                if makefilecache is not None:
+                    self.cachestamps = makefilecache.stamp(makefile)
+                self.makefile = makefile
+                return True
+
+        return False
+
+    def maketargets(self):
         if len(self.targets) == 0:
             if self.makefile.defaulttarget is None:
                 print "No target specified and no default target found."
@@ -137,27 +202,113 @@ class _MakeContext(object):
             self.realtargets = [self.makefile.defaulttarget]
             self.tstack = ['<default-target>']
         else:
-            self.realtargets = self.targets
+            self.realtargets = list(self.targets)
             self.tstack = ['<command-line>']
 
+        # As in GNU make, -q doesn't stop included makefiles from being remade
+        self.makefile.question = self.options.question
+
         self.makefile.gettarget(self.realtargets.pop(0)).make(self.makefile, self.tstack, cb=self.makecb)
 
     def makecb(self, error, didanything):
         assert error in (True, False)
 
+        if makefilecache is not None and (error or not len(self.realtargets)):
+            makefilecache.checkin(self.cachekey, self.makefile, self.cachestamps)
+
         if error:
-            self.context.defer(self.cb, 2)
+            self.finished(self.makefile.outofdate and 1 or 2)
             return
 
         if not len(self.realtargets):
+            _log.info("make.py[%i]: %i modification times read, %i served from the cache",
+                      self.makelevel, fscache.mtimesissued, fscache.mtimesserved)
+            _log.info("make.py[%i]: %i implicit rule searches, %i answered from the memo",
+                      self.makelevel, self.makefile.implicitsearches, self.makefile.implicitmemohits)
+
             if self.options.printdir:
                 print "make.py[%i]: Leaving directory '%s'" % (self.makelevel, self.workdir)
             sys.stdout.flush()
 
-            self.context.defer(self.cb, 0)
+            self.finished(0)
         else:
             self.makefile.gettarget(self.realtargets.pop(0)).make(self.makefile, self.tstack, self.makecb)
 
+    def finished(self, code):
+        if self.watcher is None:
+            self.context.defer(self.cb, code)
+        else:
+            self.context.defer(self.watchcb, code)
+
+    def watchcb(self, code):
+        """
+        With --watch, wait for files to change after each build, then make the targets again.
+        Only the targets which depend on the changed files are remade; if any of the makefiles
+        are affected, they are parsed again from scratch.
+        """
+        # A build which failed may have left jobs running
+        process.ParallelContext.abandon()
+
+        building = self.building
+        if building is None:
+            building = self.makefile.graph.nodes
+
+        remade = set()
+        for t in building:
+            if t.wasremade:
+                remade.update(t.fspaths(self.makefile))
+        self.watcher.built(remade)
+        self.watcher.watchmakefile(self.makefile)
+
+        print "make.py: build finished with exit code %i; watching for changes" % code
+        sys.stdout.flush()
+
+        while True:
+            reset = self.makefile.resetchanged(self.watcher.wait())
+            if len(reset):
+                break
+
+        makefiles = set(os.path.normpath(util.normaljoin(self.workdir, f))
+                        for f, required in self.makefile.included)
+
+        print "make.py: %i targets affected by changes" % len(reset)
+        if self.options.printdir:
+            print "make.py[%i]: Entering directory '%s'" % (self.makelevel, self.workdir)
+        sys.stdout.flush()
+
+        for t in reset:
+            if not makefiles.isdisjoint(t.fspaths(self.makefile)):
+                _log.info("make.py[%i]: Makefile %s changed, parsing again", self.makelevel, t.target)
+                self.restarts = 0
+                self.building = None
+                self.remakecb(True)
+                return
+
+        self.building = reset
+        self.maketargets()
+
+def _slowestreport(statedb, count, cb):
+    """
+    Wrap the exit callback `cb` to print the slowest targets remade during this build.
+    """
+    def reportcb(code):
+        print "make.py: slowest targets:"
+        for duration, target in statedb.slowest(count):
+            print "%10.2fs  %s" % (duration, target)
+        sys.stdout.flush()
+        cb(code)
+    return reportcb
+
+def _outputcachereport(cache, cb):
+    """
+    Wrap the exit callback `cb` to print how often the output cache was used.
+    """
+    def reportcb(code):
+        print "make.py: output cache: %i hits, %i misses, %i stored" % (cache.hits, cache.misses, cache.stores)
+        sys.stdout.flush()
+        cb(code)
+    return reportcb
+
 def main(args, env, cwd, cb):
     """
     Start a single makefile execution, given a command line, working directory, and environment.
@@ -196,6 +347,27 @@ def main(args, env, cwd, cb):
         op.add_option('-n', '--just-print', '--dry-run', '--recon',
                       action="store_true",
                       dest="justprint", default=False)
+        op.add_option('-q', '--question',
+                      action="store_true",
+                      dest="question", default=False)
+        op.add_option('--state-db',
+                      dest="statedb", default=None)
+        op.add_option('--slowest', type="int",
+                      dest="slowest", default=0)
+        op.add_option('--scan-dirs', action="store_true",
+                      dest="scandirs", default=False)
+        op.add_option('--content-hash', action="store_true",
+                      dest="contenthash", default=False)
+        op.add_option('--command-signatures', action="store_true",
+                      dest="commandsignatures", default=False)
+        op.add_option('--output-cache',
+                      dest="outputcache", default=None)
+        op.add_option('--output-cache-size', type="int",
+                      dest="outputcachesize", default=1024)
+        op.add_option('--watch', action="store_true",
+                      dest="watch", default=False)
+        op.add_option('--snapshot',
+                      dest="snapshot", default=None)
 
         options, arguments1 = op.parse_args(parsemakeflags(env))
         options, arguments2 = op.parse_args(args, values=options)
@@ -225,6 +397,11 @@ def main(args, env, cwd, cb):
         if options.justprint:
             shortflags.append('n')
 
+        if options.question:
+            shortflags.append('q')
+            # No commands are run, so there is nothing to do in parallel
+            options.jobcount = 1
+
         loglevel = logging.WARNING
         if options.verbose:
             loglevel = logging.DEBUG
@@ -243,6 +420,58 @@ def main(args, env, cwd, cb):
         if options.jobcount != 1:
             longflags.append('-j%i' % (options.jobcount,))
 
+        if options.scandirs:
+            fscache.scandirs = True
+            longflags.append('--scan-dirs')
+
+        if options.contenthash:
+            longflags.append('--content-hash')
+            if options.statedb is None:
+                options.statedb = _defaultstatedb
+
+        if options.commandsignatures:
+            longflags.append('--command-signatures')
+            if options.statedb is None:
+                options.statedb = _defaultstatedb
+
+        outputcache = None
+        if options.outputcache is not None:
+            outputcachepath = util.normaljoin(workdir, options.outputcache)
+            longflags.append('--output-cache=%s' % (outputcachepath,))
+            longflags.append('--output-cache-size=%i' % (options.outputcachesize,))
+            if options.statedb is None:
+                options.statedb = _defaultstatedb
+            try:
+                outputcache = buildcache.getcache(outputcachepath, options.outputcachesize * 1024 * 1024)
+            except OSError, e:
+                raise data.DataError("Couldn't create output cache '%s': %s" % (outputcachepath, e))
+
+            if makelevel == 0:
+                cb = _outputcachereport(outputcache, cb)
+
+        statedb = None
+        if options.statedb is not None:
+            statedbpath = util.normaljoin(workdir, options.statedb)
+            longflags.append('--state-db=%s' % (statedbpath,))
+            try:
+                statedb = builddb.getdatabase(statedbpath)
+            except (IOError, OSError), e:
+                raise data.DataError("Couldn't open build-state database '%s': %s" % (statedbpath, e))
+
+            if options.slowest > 0:
+                cb = _slowestreport(statedb, options.slowest, cb)
+        elif options.slowest > 0:
+            raise data.DataError("--slowest requires --state-db")
+
+        watcher = None
+        if options.watch:
+            if makefilecache is not None:
+                raise data.DataError("--watch can't be used with the build server")
+            try:
+                watcher = inotify.Watcher()
+            except OSError, e:
+                raise data.DataError("--watch is not available: %s" % (e,))
+
         makeflags = ''.join(shortflags)
         if len(longflags):
             makeflags += ' ' + ' '.join(longflags)
@@ -265,7 +494,15 @@ def main(args, env, cwd, cb):
 
         ostmts, targets, overrides = parserdata.parsecommandlineargs(arguments)
 
-        _MakeContext(makeflags, makelevel, workdir, context, env, targets, options, ostmts, overrides, cb)
+        snapshotpath = None
+        if options.snapshot is not None:
+            snapshotpath = util.normaljoin(workdir, options.snapshot)
+
+        cachekey = None
+        if makefilecache is not None or snapshotpath is not None:
+            cachekey = (tuple(args), tuple(sorted(env.iteritems())), cwd)
+
+        _MakeContext(makeflags, makelevel, workdir, context, env, targets, options, ostmts, overrides, statedb, outputcache, cachekey, snapshotpath, watcher, cb)
     except (util.MakeError), e:
         print e
         if options.printdir:
@@ -0,0 +1,284 @@
+"""
+A build server, which keeps parsed makefiles and other state in memory between makes.
+
+serve() listens on a Unix socket. make.py forwards its command line, environment and working
+directory to the server named by the PYMAKE_DAEMON environment variable, if it is running,
+instead of making the targets itself. A request is a single line of JSON:
+
+  {"argv": [...], "env": {...}, "cwd": "..."}
+
+The server runs the make with its standard output and error redirected to the connection,
+then writes `exitmarker`, the exit code, and a newline. Requests are served one at a time.
+
+Between makes the server keeps:
+
+* parsed makefiles, in the parser's cache, which notices when they change
+* for each distinct command line, environment and working directory, the data.Makefile
+  built by parsing them. It is reused if none of the makefiles it read have changed, and every
+  $(shell) and $(wildcard) used while parsing still has the same result.
+* imported modules, Python functions, and the job pools
+* the filesystem cache. The directories of the paths it holds are watched with inotify, and
+  paths which changed between makes are forgotten before the next one. Without inotify, it is
+  emptied before each make.
+
+Everything else, such as logging, belongs to a single make and is set up again for each one.
+"""
+
+import os, sys, socket, json, logging, traceback
+import command, process, fscache, snapshot, inotify
+
+_log = logging.getLogger('pymake.daemon')
+
+exitmarker = '\0pymake-exit:'
+
+class MakefileCache(object):
+    """
+    Makefiles kept between makes, keyed on (argv, environment items, cwd). A Makefile is
+    checked out while a make uses it, so makes running at the same time never share one.
+    """
+
+    MAXENTRIES = 16
+
+    def __init__(self):
+        self._entries = {} # key -> (makefile, stamps)
+        self._order = [] # keys, least recently checked in first
+
+    def stamp(self, makefile):
+        """
+        Record the state of the files `makefile` was parsed from.
+        """
+        return snapshot.makefilestamps(makefile)
+
+    def checkout(self, key):
+        """
+        Get (makefile, stamps) for `key` if there is an entry which is still valid, and remove
+        it from the cache.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        self._order.remove(key)
+
+        makefile, stamps = entry
+        changed = snapshot.changedstamp(stamps)
+        if changed is not None:
+            _log.info("Not reusing makefiles: %s changed", changed)
+            return None
+
+        if makefile.parseinputschanged():
+            _log.info("Not reusing makefiles: $(shell) or $(wildcard) results may have changed")
+            return None
+
+        return entry
+
+    def checkin(self, key, makefile, stamps):
+        if key in self._entries:
+            self._order.remove(key)
+        self._entries[key] = makefile, stamps
+        self._order.append(key)
+
+        if len(self._order) > self.MAXENTRIES:
+            del self._entries[self._order.pop(0)]
+
+class StatCache(object):
+    """
+    Keep the filesystem cache between makes, forgetting the paths which changed in between.
+    """
+
+    def __init__(self):
+        try:
+            self._inotify = inotify.Inotify()
+        except OSError, e:
+            _log.info("Not keeping the filesystem cache between makes: %s", e)
+            self._inotify = None
+
+    def beforemake(self):
+        """
+        Forget the paths which changed since the last make.
+        """
+        if self._inotify is None:
+            fscache.reset()
+            return
+
+        while True:
+            paths = self._inotify.read(0)
+            if not paths:
+                break
+            for path in paths:
+                if self._inotify.watching(path):
+                    # A watched directory was removed, or events were lost
+                    fscache.reset()
+                    return
+                fscache.invalidate(path)
+
+    def aftermake(self):
+        """
+        Watch the directories of the paths the make looked at. Paths in directories which
+        weren't watched while the make looked at them may already have changed, so they are
+        forgotten.
+        """
+        if self._inotify is None:
+            return
+
+        paths, dirs = fscache.cached()
+        for path in paths:
+            self._keep(os.path.dirname(path), path)
+        for dir in dirs:
+            self._keep(dir, dir)
+
+    def _keep(self, dir, path):
+        if self._inotify.watching(dir):
+            return
+
+        if os.path.isabs(dir):
+            try:
+                self._inotify.watch(dir)
+            except OSError, e:
+                _log.info("Couldn't watch '%s': %s", dir, e)
+        fscache.invalidate(path)
+
+class _MakeFinished(Exception):
+    def __init__(self, code):
+        Exception.__init__(self)
+        self.code = code
+
+def _finished(code):
+    raise _MakeFinished(code)
+
+def _make(argv, env, cwd, statcache):
+    """
+    Run a make to completion and return its exit code.
+    """
+    statcache.beforemake()
+    fscache.scandirs = False
+    process.startbuild()
+    os.chdir(cwd)
+
+    # Let the make configure logging with logging.basicConfig, which does nothing if the root
+    # logger already has handlers
+    root = logging.getLogger()
+    savedlevel, savedhandlers = root.level, root.handlers[:]
+    for h in savedhandlers:
+        root.removeHandler(h)
+
+    try:
+        try:
+            command.main(argv, env, cwd, _finished)
+            process.ParallelContext.spin()
+        except _MakeFinished, e:
+            code = e.code
+        except SystemExit, e:
+            code = e.code or 0
+        except Exception:
+            traceback.print_exc()
+            code = 2
+
+        # A make which stopped early, after an error, may have left jobs behind
+        process.ParallelContext.abandon()
+    finally:
+        for h in root.handlers[:]:
+            root.removeHandler(h)
+            h.close()
+        for h in savedhandlers:
+            root.addHandler(h)
+        root.setLevel(savedlevel)
+
+    statcache.aftermake()
+    return code
+
+def _handle(conn, statcache):
+    fd = conn.makefile('rb')
+    request = json.loads(fd.readline())
+    fd.close()
+
+    argv = [str(a) for a in request['argv']]
+    env = dict((str(k), str(v)) for k, v in request['env'].iteritems())
+    cwd = str(request['cwd'])
+
+    # Makes run by commands must not ask this server, which is busy
+    env.pop('PYMAKE_DAEMON', None)
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    savedout, savederr = os.dup(1), os.dup(2)
+    os.dup2(conn.fileno(), 1)
+    os.dup2(conn.fileno(), 2)
+    try:
+        code = _make(argv, env, cwd, statcache)
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(savedout, 1)
+        os.dup2(savederr, 2)
+        os.close(savedout)
+        os.close(savederr)
+
+    conn.sendall('%s%i\n' % (exitmarker, code))
+
+def serve(path):
+    """
+    Serve makes on the Unix socket at `path` until killed.
+    """
+    if os.path.exists(path):
+        os.remove(path)
+
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.bind(path)
+    s.listen(5)
+
+    command.makefilecache = MakefileCache()
+    statcache = StatCache()
+
+    while True:
+        conn, addr = s.accept()
+        try:
+            _handle(conn, statcache)
+        except Exception:
+            _log.error("Error serving a request:\n%s", traceback.format_exc())
+        finally:
+            conn.close()
+
+def request(path, argv, env, cwd, out=sys.stdout):
+    """
+    Ask the server listening at `path` to run a make, copying its output to `out`. Returns
+    the exit code, or None if there is no server or the request can't be sent to it, such as
+    when the environment isn't valid UTF-8.
+    """
+    try:
+        message = json.dumps({'argv': argv, 'env': dict(env), 'cwd': cwd}) + '\n'
+    except (UnicodeDecodeError, ValueError):
+        return None
+
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+    except socket.error:
+        s.close()
+        return None
+
+    s.sendall(message)
+
+    # Copy output until the exit marker. Output which might be the start of the marker is
+    # held back until the next read.
+    pending = ''
+    while True:
+        data = s.recv(65536)
+        if not data:
+            s.close()
+            out.write(pending)
+            print >>out, "make.py: lost the connection to the build server"
+            return 2
+
+        pending += data
+        i = pending.find(exitmarker)
+        if i != -1 and pending.endswith('\n', i):
+            out.write(pending[:i])
+            out.flush()
+            s.close()
+            return int(pending[i + len(exitmarker):].strip())
+
+        if i == -1:
+            keep = len(exitmarker) - 1
+            out.write(pending[:-keep])
+            out.flush()
+            pending = pending[-keep:]
@@ -2,9 +2,10 @@
 A representation of makefile data structures.
 """
 
-import logging, re, os, sys
-import parserdata, parser, functions, process, util, implicit
+import logging, re, os, sys, types, time, hashlib
+import parserdata, parser, functions, process, util, implicit, fscache
 from cStringIO import StringIO
+from globrelative import glob
 
 _log = logging.getLogger('pymake.data')
 
@@ -38,11 +39,7 @@ def mtimeislater(deptime, targettime):
     return deptime > targettime
 
 def getmtime(path):
-    try:
-        s = os.stat(path)
-        return s.st_mtime
-    except OSError:
-        return None
+    return fscache.getmtime(path)
 
 def stripdotslash(s):
     if s.startswith('./'):
@@ -70,6 +67,9 @@ class StringExpansion(object):
         self.s = s
         self.loc = loc
 
+    def __reduce__(self):
+        return StringExpansion, (self.s, self.loc)
+
     def lstrip(self):
         self.s = self.s.lstrip()
 
@@ -214,13 +214,102 @@ class Expansion(list):
     def __repr__(self):
         return "<Expansion with elements: %r>" % ([e for e, isfunc in self],)
 
+def _parsevalue(s, name):
+    d = parser.Data.fromstring(s, parserdata.Location("Expansion of variables '%s'" % (name,), 1, 0))
+    e, t, o = parser.parsemakesyntax(d, 0, (), parser.iterdata)
+    return e
+
+class _ValueRope(object):
+    """
+    The value of a variable which has been appended to with +=. The appended chunks are kept
+    separately and only joined with spaces when the value is read, so that a long series of
+    appends doesn't copy the whole value every time. For recursively-expanded variables each
+    chunk is parsed once, and the parsed chunks are concatenated when the expansion is read.
+    """
+
+    __slots__ = ('chunks', 'exps', '_str', '_exp', '_parentexp', '_appendedexp')
+
+    def __init__(self, s):
+        self.chunks = [s]
+        self.exps = [] # parsed expansions of self.chunks[:len(self.exps)]
+        self._str = None
+        self._exp = None
+
+        # For FLAVOR_APPEND, the most recent parent expansion and the result of appending to it
+        self._parentexp = None
+        self._appendedexp = None
+
+    def append(self, s):
+        self.chunks.append(s)
+        self._str = None
+        self._exp = None
+        self._parentexp = None
+        self._appendedexp = None
+
+    def getstr(self):
+        if self._str is None:
+            self._str = ' '.join(self.chunks)
+        return self._str
+
+    def getexpansion(self, name, simple):
+        """
+        Get the value as an expansion. Simply-expanded chunks were already resolved when they
+        were appended; recursively-expanded chunks are parsed.
+        """
+        if self._exp is None:
+            if simple:
+                self._exp = Expansion.fromstring(self.getstr(), "Expansion of variable '%s'" % (name,))
+            else:
+                self._exp = self._parse(name)
+        return self._exp
+
+    def _parse(self, name):
+        exps = self.exps
+        for c in self.chunks[len(exps):]:
+            # A chunk ending with an unescaped $ or containing an unterminated function
+            # only makes sense when joined with the chunk after it.
+            if (len(c) - len(c.rstrip('$'))) % 2 == 1:
+                return _parsevalue(self.getstr(), name)
+            try:
+                exps.append(_parsevalue(c, name))
+            except parser.SyntaxError:
+                return _parsevalue(self.getstr(), name)
+
+        if len(exps) == 1:
+            return exps[0]
+
+        e = Expansion(loc=exps[0].loc)
+        e.concat(exps[0])
+        for ce in exps[1:]:
+            e.appendstr(' ')
+            e.concat(ce)
+        return e.finish()
+
+    def appendto(self, pvalue, name):
+        """
+        Get the expansion of a FLAVOR_APPEND variable appended to its parent value. The result
+        is kept until the parent value or this value changes.
+        """
+        if pvalue is not self._parentexp:
+            e = pvalue.clone()
+            e.appendstr(' ')
+            e.concat(self.getexpansion(name, False))
+            self._parentexp = pvalue
+            self._appendedexp = e
+        return self._appendedexp
+
+def _valuestr(value):
+    if isinstance(value, _ValueRope):
+        return value.getstr()
+    return value
+
 class Variables(object):
     """
     A mapping from variable names to variables. Variables have flavor, source, and value. The value is an 
     expansion object.
     """
 
-    __slots__ = ('parent', '_map')
+    __slots__ = ('parent', '_map', '_env', '_envappends')
 
     FLAVOR_RECURSIVE = 0
     FLAVOR_SIMPLE = 1
@@ -234,12 +323,64 @@ class Variables(object):
     SOURCE_IMPLICIT = 5
 
     def __init__(self, parent=None):
-        self._map = {} # vname -> flavor, source, valuestr, valueexp
+        # vname -> flavor, source, value, valueexp
+        # value is a string, or a _ValueRope if the variable has been appended to. valueexp
+        # caches the expansion of a string value.
+        self._map = {}
         self.parent = parent
+        self._env = None
+        self._envappends = None # {vname: (flavor, appended chunks)} until readfromenvironment
 
     def readfromenvironment(self, env):
-        for k, v in env.iteritems():
-            self.set(k, self.FLAVOR_SIMPLE, self.SOURCE_ENVIRONMENT, v)
+        """
+        Make the variables in `env` visible with SOURCE_ENVIRONMENT. The mapping is not copied:
+        a variable is copied into this object only when it is read or set, so `env` must not be
+        modified afterwards.
+        """
+        self._env = env
+
+        if self._envappends is not None:
+            for name, (flavor, chunks) in self._envappends.iteritems():
+                value = _ValueRope(env.get(name, ''))
+                for c in chunks:
+                    value.append(c)
+                self._map[name] = flavor, self.SOURCE_ENVIRONMENT, value, None
+            self._envappends = None
+
+    def __getstate__(self):
+        """
+        Variables are pickled without the values read from the environment, which may hold
+        secrets: they are read again by readfromenvironment. Of an environment variable which
+        was appended to, only the appended chunks are kept.
+        """
+        map = {}
+        envappends = None
+        if self._env is not None:
+            envappends = {}
+        for name, entry in self._map.iteritems():
+            flavor, source, value, valueexp = entry
+            if source == self.SOURCE_ENVIRONMENT and self._env is not None and name in self._env:
+                if isinstance(value, _ValueRope):
+                    if value.chunks[0] == self._env[name]:
+                        envappends[name] = flavor, value.chunks[1:]
+                        continue
+                elif value == self._env[name]:
+                    continue
+            map[name] = entry
+        return self.parent, map, envappends
+
+    def __setstate__(self, state):
+        self.parent, self._map, self._envappends = state
+        self._env = None
+
+    def _lookup(self, name):
+        entry = self._map.get(name, None)
+        if entry is None and self._env is not None:
+            value = self._env.get(name, None)
+            if value is not None:
+                entry = self.FLAVOR_SIMPLE, self.SOURCE_ENVIRONMENT, value, None
+                self._map[name] = entry
+        return entry
 
     def get(self, name, expand=True):
         """
@@ -250,13 +391,9 @@ class Variables(object):
         @param expand If true, the value will be returned as an expansion. If false,
         it will be returned as an unexpanded string.
         """
-        flavor, source, valuestr, valueexp = self._map.get(name, (None, None, None, None))
-        if flavor is not None:
-            if expand and flavor != self.FLAVOR_SIMPLE and valueexp is None:
-                d = parser.Data.fromstring(valuestr, parserdata.Location("Expansion of variables '%s'" % (name,), 1, 0))
-                valueexp, t, o = parser.parsemakesyntax(d, 0, (), parser.iterdata)
-                self._map[name] = flavor, source, valuestr, valueexp
-
+        entry = self._lookup(name)
+        if entry is not None:
+            flavor, source, value, valueexp = entry
             if flavor == self.FLAVOR_APPEND:
                 if self.parent:
                     pflavor, psource, pvalue = self.parent.get(name, expand)
@@ -272,23 +409,24 @@ class Variables(object):
                         return pflavor, psource, pvalue
 
                     if not expand:
-                        return pflavor, psource, pvalue + ' ' + valuestr
-
-                    pvalue = pvalue.clone()
-                    pvalue.appendstr(' ')
-                    pvalue.concat(valueexp)
+                        return pflavor, psource, pvalue + ' ' + value.getstr()
 
-                    return pflavor, psource, pvalue
+                    return pflavor, psource, value.appendto(pvalue, name)
                     
             if not expand:
-                return flavor, source, valuestr
+                return flavor, source, _valuestr(value)
 
-            if flavor == self.FLAVOR_RECURSIVE:
-                val = valueexp
-            else:
-                val = Expansion.fromstring(valuestr, "Expansion of variable '%s'" % (name,))
+            if isinstance(value, _ValueRope):
+                return flavor, source, value.getexpansion(name, flavor == self.FLAVOR_SIMPLE)
 
-            return flavor, source, val
+            if valueexp is None:
+                if flavor == self.FLAVOR_RECURSIVE:
+                    valueexp = _parsevalue(value, name)
+                else:
+                    valueexp = Expansion.fromstring(value, "Expansion of variable '%s'" % (name,))
+                self._map[name] = flavor, source, value, valueexp
+
+            return flavor, source, valueexp
 
         if self.parent is not None:
             return self.parent.get(name, expand)
@@ -312,37 +450,55 @@ class Variables(object):
         assert source in (self.SOURCE_OVERRIDE, self.SOURCE_MAKEFILE, self.SOURCE_AUTOMATIC)
         assert isinstance(value, str)
 
-        if name not in self._map:
-            self._map[name] = self.FLAVOR_APPEND, source, value, None
+        entry = self._lookup(name)
+        if entry is None:
+            self._map[name] = self.FLAVOR_APPEND, source, _ValueRope(value), None
             return
 
-        prevflavor, prevsource, prevvalue, valueexp = self._map[name]
+        prevflavor, prevsource, prevvalue, valueexp = entry
         if source > prevsource:
             # TODO: log a warning?
             return
 
         if prevflavor == self.FLAVOR_SIMPLE:
-            d = parser.Data.fromstring(value, parserdata.Location("Expansion of variables '%s'" % (name,), 1, 0))
-            valueexp, t, o = parser.parsemakesyntax(d, 0, (), parser.iterdata)
+            value = _parsevalue(value, name).resolvestr(makefile, variables, [name])
 
-            val = valueexp.resolvestr(makefile, variables, [name])
-            self._map[name] = prevflavor, prevsource, prevvalue + ' ' + val, None
-            return
+        if not isinstance(prevvalue, _ValueRope):
+            prevvalue = _ValueRope(prevvalue)
+            if valueexp is not None and prevflavor == self.FLAVOR_RECURSIVE:
+                prevvalue.exps.append(valueexp)
+            self._map[name] = prevflavor, prevsource, prevvalue, None
 
-        newvalue = prevvalue + ' ' + value
-        self._map[name] = prevflavor, prevsource, newvalue, None
+        prevvalue.append(value)
 
     def merge(self, other):
         assert isinstance(other, Variables)
         for k, flavor, source, value in other:
             self.set(k, flavor, source, value)
 
+    def overlay(self, parent):
+        """
+        Get a view of the variables set in this object whose parent is `parent`. The view shares
+        this object's variables rather than copying them, and must not be modified. Variables
+        which read the environment can't be overlaid: a pickled view would lose the values
+        readfromenvironment() puts back.
+        """
+        assert self._env is None, "can't overlay variables which read the environment"
+        v = Variables(parent)
+        v._map = self._map
+        return v
+
     def __iter__(self):
         for k, (flavor, source, value, valueexp) in self._map.iteritems():
-            yield k, flavor, source, value
+            yield k, flavor, source, _valuestr(value)
+
+        if self._env is not None:
+            for k, v in self._env.iteritems():
+                if k not in self._map:
+                    yield k, self.FLAVOR_SIMPLE, self.SOURCE_ENVIRONMENT, v
 
     def __contains__(self, item):
-        return item in self._map
+        return item in self._map or (self._env is not None and item in self._env)
 
 class Pattern(object):
     """
@@ -582,7 +738,24 @@ class RemakeTargetParallel(object):
         self.currunning = False
         self.runnext()
 
+def _commandsignature(commands):
+    """
+    Hash the expanded command lines of a rule.
+    """
+    h = hashlib.sha1()
+    for c in commands:
+        h.update(c.cline)
+        h.update('\n')
+    return h.hexdigest()
+
 class RemakeRuleContext(object):
+    """
+    Makes the prerequisites of one rule of a target, then runs its commands if the target is
+    out of date. In parallel, every prerequisite is started at once and `depsremaining` counts
+    the ones which haven't finished; the commands become ready when it reaches zero. Each
+    finished prerequisite costs a constant amount of work, however many there are.
+    """
+
     def __init__(self, target, makefile, rule, deps,
                  targetstack, avoidremakeloop):
         self.target = target
@@ -613,29 +786,42 @@ class RemakeRuleContext(object):
     def _depfinishedserial(self, error, didanything):
         assert error in (True, False)
 
-        if didanything:
-            self.didanything = True
+        while True:
+            if didanything:
+                self.didanything = True
 
-        if error:
-            self.error = True
-            if not self.makefile.keepgoing:
-                self.resolvecb(error=True, didanything=self.didanything)
+            if error:
+                self.error = True
+                if not self.makefile.keepgoing:
+                    self.resolvecb(error=True, didanything=self.didanything)
+                    return
+
+            if self.resolvenext == len(self.deps):
+                self.resolvecb(error=self.error, didanything=self.didanything)
                 return
-        
-        if len(self.resolvelist):
-            dep, weak = self.resolvelist.pop(0)
-            self.makefile.context.defer(dep.make,
-                                        self.makefile, self.targetstack, weak and self._weakdepfinishedserial or self._depfinishedserial)
-        else:
-            self.resolvecb(error=self.error, didanything=self.didanything)
+
+            dep, weak = self.deps[self.resolvenext]
+            self.resolvenext += 1
+
+            if dep._state != MAKESTATE_FINISHED:
+                self.makefile.context.defer(dep.make,
+                                            self.makefile, self.targetstack, weak and self._weakdepfinishedserial or self._depfinishedserial)
+                return
+
+            # Prerequisites which were already made are taken here, rather than with a trip
+            # through the context for each one
+            error, didanything = dep.error, dep.didanything
+            if weak and error:
+                self.remake = True
+                error = False
 
     def _resolvedepsserial(self):
-        self.resolvelist = list(self.deps)
+        self.resolvenext = 0
         self._depfinishedserial(False, False)
 
     def _startdepparallel(self, d):
-        if self.makefile.error:
-            depfinished(True, False)
+        if self.makefile.error and not self.makefile.keepgoing:
+            self._depfinishedparallel(True, False)
         else:
             dep, weak = d
             dep.make(self.makefile, self.targetstack, weak and self._weakdepfinishedparallel or self._depfinishedparallel)
@@ -667,19 +853,156 @@ class RemakeRuleContext(object):
         self.didanything = False
 
         for d in self.deps:
-            self.makefile.context.defer(self._startdepparallel, d)
+            if d[0]._state == MAKESTATE_FINISHED:
+                # Already made, so this just counts it
+                self._startdepparallel(d)
+            else:
+                self.makefile.context.defer(self._startdepparallel, d)
 
     def _commandcb(self, error):
         assert error in (True, False)
 
-        if error:
-            self.runcb(error=True)
+        if self.currentcommand is not None:
+            self.duration += self.currentcommand.duration
+
+        if self.startingcommand:
+            # The command finished before returning, as commands printed by -n do: the loop
+            # below starts the next one, so that a long rule doesn't nest a call per command
+            self.syncerror = error
             return
 
-        if len(self.commands):
-            self.commands.pop(0)(self._commandcb)
-        else:
-            self.runcb(error=False)
+        while True:
+            if error:
+                self._commandsfinished(True)
+                return
+
+            if not len(self.commands):
+                self._commandsfinished(False)
+                return
+
+            self.currentcommand = self.commands.pop(0)
+            self.syncerror = None
+            self.startingcommand = True
+            self.currentcommand(self._commandcb)
+            self.startingcommand = False
+
+            if self.syncerror is None:
+                return
+            error = self.syncerror
+
+    def _commandsfinished(self, error):
+        path = util.normaljoin(self.makefile.workdir, self.target.target)
+        fscache.invalidate(path)
+
+        if not error and self.cachekey is not None and not self.restored:
+            self.makefile.outputcache.store(self.cachekey, path)
+
+        db = self.makefile.statedb
+        if db is not None and not self.makefile.justprint:
+            if not self.restored:
+                db.recordbuild(self.makefile.getstatedbpath(self.target),
+                               duration=self.duration,
+                               status=error and self.currentcommand.res or 0,
+                               time=time.time())
+
+            if self.starthashes is not None:
+                prerequisites = None
+                if not error:
+                    prerequisites = self.starthashes
+                db.record(self.makefile.getstatedbpath(self.target), prerequisites=prerequisites)
+
+            if self.signature is not None:
+                signature = None
+                if not error:
+                    signature = self.signature
+                db.record(self.makefile.getstatedbpath(self.target), signature=signature)
+
+        self.runcb(error=error)
+
+    def _getsignature(self):
+        """
+        Expand the commands into self.signature, as they would run if the target were remade
+        from scratch: $@ is the target itself and $? lists every prerequisite, so that the
+        signature doesn't depend on where vpath found the target or on which prerequisites
+        happen to be newer. On error, report it and return False.
+        """
+        t = self.target
+        vpathtarget, realmtime = t.vpathtarget, getattr(t, 'realmtime', None)
+        t.vpathtarget, t.realmtime = t.target, None
+        try:
+            if not self._getcommands():
+                return False
+        finally:
+            t.vpathtarget, t.realmtime = vpathtarget, realmtime
+
+        self.signature = _commandsignature(self.commands)
+
+        # The commands which actually run are expanded again once the target is being remade
+        self.commands = None
+        return True
+
+    def _getcommands(self):
+        """
+        Expand the commands of the rule into self.commands. On error, report it and return
+        False.
+        """
+        try:
+            self.commands = [c for c in self.rule.getcommands(self.target, self.makefile)]
+        except util.MakeError, e:
+            print e
+            sys.stdout.flush()
+            self.runcb(error=True)
+            return False
+        return True
+
+    def _outputcachekey(self):
+        """
+        Get the key of the output cache entry for the commands about to be run: a hash of the
+        commands and of the contents of the prerequisites. Returns None if the output shouldn't
+        be cached: only targets listed as prerequisites of .PYMAKE_CACHEABLE are, and only if
+        all of their prerequisites are files.
+        """
+        cache = self.makefile.outputcache
+        if cache is None or self.makefile.justprint or self.rule.doublecolon or \
+                self.target.target not in self.makefile.cacheabletargets or \
+                self.target.isphony(self.makefile):
+            return None
+
+        db = self.makefile.statedb
+        h = hashlib.sha1()
+        h.update(self.signature or _commandsignature(self.commands))
+        for d, weak in self.deps:
+            hash = db.filehash(util.normaljoin(self.makefile.workdir, d.vpathtarget))
+            if hash is None:
+                return None
+            h.update('%s\0%s\n' % (d.vpathtarget, hash))
+        return h.hexdigest()
+
+    def _prerequisiteshashes(self):
+        """
+        Get a dict mapping the path of each prerequisite to the hash of its contents.
+        """
+        db = self.makefile.statedb
+        hashes = {}
+        for d, weak in self.deps:
+            path = util.normaljoin(self.makefile.workdir, d.vpathtarget)
+            hashes[path] = db.filehash(path)
+        return hashes
+
+    def _prerequisiteshashesmatch(self):
+        """
+        With --content-hash, check whether the contents of every prerequisite are the same as
+        when the target was last remade.
+        """
+        if not self.makefile.contenthash or self.rule.doublecolon:
+            return False
+
+        record = self.makefile.statedb.get(self.makefile.getstatedbpath(self.target))
+        if record is None or record.get('prerequisites', None) is None:
+            return False
+
+        hashes = self._prerequisiteshashes()
+        return None not in hashes.itervalues() and hashes == record['prerequisites']
 
     def runcommands(self, indent, cb):
         assert not self.running
@@ -689,11 +1012,11 @@ class RemakeRuleContext(object):
 
         if self.rule is None or not len(self.rule.commands):
             if self.target.mtime is None:
-                self.target.beingremade()
+                self.target.beingremade(self.makefile)
             else:
                 for d, weak in self.deps:
                     if mtimeislater(d.mtime, self.target.mtime):
-                        self.target.beingremade()
+                        self.target.beingremade(self.makefile)
                         break
             cb(error=False)
             return
@@ -722,19 +1045,61 @@ class RemakeRuleContext(object):
         if not remake:
             for d, weak in self.deps:
                 if mtimeislater(d.mtime, self.target.mtime):
+                    if self._prerequisiteshashesmatch():
+                        _log.info("%sNot remaking %s using rule at %s: %s is newer, but no prerequisite's contents have changed.", indent, self.target.target, self.rule.loc, d.target)
+                        break
+
                     _log.info("%sRemaking %s using rule at %s because %s is newer.", indent, self.target.target, self.rule.loc, d.target)
                     remake = True
                     break
 
+        self.commands = None
+        self.signature = None
+        if self.makefile.commandsignatures and not self.rule.doublecolon:
+            if not self._getsignature():
+                return
+
+            db = self.makefile.statedb
+            record = db.get(self.makefile.getstatedbpath(self.target))
+            oldsignature = record is not None and record.get('signature', None) or None
+            if oldsignature is None:
+                # Adopt the commands of targets built before signatures were recorded
+                if not remake and not self.makefile.justprint:
+                    db.record(self.makefile.getstatedbpath(self.target), signature=self.signature)
+            elif oldsignature != self.signature and not remake:
+                _log.info("%sRemaking %s using rule at %s because its commands changed.", indent, self.target.target, self.rule.loc)
+                remake = True
+
+        if remake and self.makefile.question:
+            _log.info("%s%s is out of date", indent, self.target.target)
+            self.makefile.outofdate = True
+            cb(error=True)
+            return
+
         if remake:
-            self.target.beingremade()
+            self.target.beingremade(self.makefile)
             self.target.didanything = True
-            try:
-                self.commands = [c for c in self.rule.getcommands(self.target, self.makefile)]
-            except util.MakeError, e:
-                print e
-                sys.stdout.flush()
-                cb(error=True)
+            if self.commands is None and not self._getcommands():
+                return
+
+            self.currentcommand = None
+            self.startingcommand = False
+            self.duration = 0.0
+
+            # Hash the prerequisites as the commands start, so that one edited while they run
+            # isn't recorded as built
+            self.starthashes = None
+            if self.makefile.contenthash and not self.rule.doublecolon and \
+                    self.makefile.statedb is not None and not self.makefile.justprint:
+                self.starthashes = self._prerequisiteshashes()
+
+            self.restored = False
+            self.cachekey = self._outputcachekey()
+            if self.cachekey is not None and \
+                    self.makefile.outputcache.restore(self.cachekey, util.normaljoin(self.makefile.workdir, self.target.target)):
+                _log.info("%sRestored %s from the output cache", indent, self.target.target)
+                self.restored = True
+                self._commandsfinished(False)
                 return
 
             self._commandcb(False)
@@ -757,6 +1122,8 @@ class Target(object):
     """
 
     wasremade = False
+    patternvariablesapplied = False
+    implicitrule = None # the PatternRuleInstance added by resolveimplicitrule
 
     def __init__(self, target, makefile):
         assert isinstance(target, str)
@@ -766,6 +1133,7 @@ class Target(object):
         self.variables = Variables(makefile.variables)
         self.explicit = False
         self._state = MAKESTATE_NONE
+        self.nodeid = None
 
     def addrule(self, rule):
         assert isinstance(rule, (Rule, PatternRuleInstance))
@@ -785,6 +1153,8 @@ class Target(object):
 
     def isphony(self, makefile):
         """Is this a phony target? We don't check for existence of phony targets."""
+        if makefile.phonytargets is not None:
+            return self.target in makefile.phonytargets
         return makefile.gettarget('.PHONY').hasdependency(self.target)
 
     def hasdependency(self, t):
@@ -807,11 +1177,47 @@ class Target(object):
         dir, s, file = util.strrpartition(self.target, '/')
         dir = dir + s
 
-        candidates = [] # list of PatternRuleInstance
+        # Only pattern rules in the rule stack change which rules may be tried
+        memokey = (dir, file, frozenset(r for r in rulestack if isinstance(r, PatternRule)))
+        memo = makefile.getimplicitmemo()
+        makefile.implicitsearches += 1
+        if memokey in memo:
+            makefile.implicitmemohits += 1
+            c = memo[memokey]
+            if c is None:
+                _log.info("%sCouldn't find implicit rule to remake '%s' (remembered)", indent, self.target)
+            else:
+                _log.info("%sFound implicit rule at %s for target '%s' (remembered)", indent, c[0].loc, self.target)
+                self._addimplicitrule(makefile, c)
+            return
+
+        recursivedeps = makefile.recursivedeps
+        c = self._searchimplicitrule(makefile, targetstack, rulestack, indent, dir, file)
+
+        # A search which met a recursive dependency depended on targetstack, so it may have a
+        # different result elsewhere
+        if makefile.recursivedeps == recursivedeps:
+            memo[memokey] = c
+        if c is None:
+            _log.info("%sCouldn't find implicit rule to remake '%s'", indent, self.target)
+        else:
+            self._addimplicitrule(makefile, c)
+
+    def _searchimplicitrule(self, makefile, targetstack, rulestack, indent, dir, file):
+        """
+        Find the implicit rule to build this target, as a (PatternRule, dir, stem, ismatchany)
+        tuple, or None.
+        """
+        candidates = [] # list of (PatternRule, dir, stem, ismatchany)
+
+        entries = makefile.implicitruleindex.candidates(self.target)
+        if dir != '':
+            entries = sorted(set(entries).union(makefile.implicitruleindex.candidates(file)))
 
-        hasmatch = util.any((r.hasspecificmatch(file) for r in makefile.implicitrules))
+        hasmatch = util.any((not p.ismatchany() and p.match(file) is not None
+                             for seq, p, r in entries))
 
-        for r in makefile.implicitrules:
+        for seq, p, r in entries:
             if r in rulestack:
                 _log.info("%s %s: Avoiding implicit rule recursion", indent, r.loc)
                 continue
@@ -819,14 +1225,26 @@ class Target(object):
             if not len(r.commands):
                 continue
 
-            for ri in r.matchesfor(dir, file, hasmatch):
-                candidates.append(ri)
-            
+            if p.ismatchany():
+                if hasmatch and not r.doublecolon:
+                    continue
+
+                candidates.append((r, dir, file, True))
+            else:
+                stem = p.match(self.target)
+                if stem is not None:
+                    candidates.append((r, '', stem, False))
+                else:
+                    stem = p.match(file)
+                    if stem is not None:
+                        candidates.append((r, dir, stem, False))
+
         newcandidates = []
 
-        for r in candidates:
+        for c in candidates:
+            r, cdir, stem, ismatchany = c
             depfailed = None
-            for p in r.prerequisites:
+            for p in r.prerequisitesforstem(cdir, stem):
                 t = makefile.gettarget(p)
                 t.resolvevpath(makefile)
                 if not t.explicit and t.mtime is None:
@@ -837,20 +1255,20 @@ class Target(object):
                 if r.doublecolon:
                     _log.info("%s Terminal rule at %s doesn't match: prerequisite '%s' not mentioned and doesn't exist.", indent, r.loc, depfailed)
                 else:
-                    newcandidates.append(r)
+                    newcandidates.append(c)
                 continue
 
             _log.info("%sFound implicit rule at %s for target '%s'", indent, r.loc, self.target)
-            self.rules.append(r)
-            return
+            return c
 
         # Try again, but this time with chaining and without terminal (double-colon) rules
 
-        for r in newcandidates:
-            newrulestack = rulestack + [r.prule]
+        for c in newcandidates:
+            r, cdir, stem, ismatchany = c
+            newrulestack = rulestack + [r]
 
             depfailed = None
-            for p in r.prerequisites:
+            for p in r.prerequisitesforstem(cdir, stem):
                 t = makefile.gettarget(p)
                 try:
                     t.resolvedeps(makefile, targetstack, newrulestack, True)
@@ -863,10 +1281,42 @@ class Target(object):
                 continue
 
             _log.info("%sFound implicit rule at %s for target '%s'", indent, r.loc, self.target)
-            self.rules.append(r)
-            return
+            return c
+
+        return None
+
+    def _addimplicitrule(self, makefile, candidate):
+        r, dir, stem, ismatchany = candidate
+        ri = PatternRuleInstance(r, dir, stem, ismatchany)
+        self.rules.append(ri)
+        self.implicitrule = ri
+        makefile.graph.addrule(self, ri)
+
+    def resetstate(self, makefile):
+        """
+        Forget the results of resolving and making this target, including any implicit rule
+        found for it, so that it can be made again.
+        """
+        if self.implicitrule is not None:
+            self.rules.remove(self.implicitrule)
+            makefile.graph.removerule(self, self.implicitrule)
+            self.implicitrule = None
+
+        self._state = MAKESTATE_NONE
+        self.vpathtarget = None
+        self.mtime = None
+        self.wasremade = False
+        self.error = False
+        self.didanything = False
 
-        _log.info("%sCouldn't find implicit rule to remake '%s'", indent, self.target)
+    def fspaths(self, makefile):
+        """
+        The normalized filesystem paths of this target, and of the file vpath found for it.
+        """
+        paths = [os.path.normpath(util.normaljoin(makefile.workdir, self.target))]
+        if self.vpathtarget is not None and self.vpathtarget != self.target:
+            paths.append(os.path.normpath(util.normaljoin(makefile.workdir, self.vpathtarget)))
+        return paths
 
     def ruleswithcommands(self):
         "The number of rules with commands"
@@ -891,6 +1341,7 @@ class Target(object):
         assert makefile.parsingfinished
 
         if self.target in targetstack:
+            makefile.recursivedeps += 1
             raise ResolutionError("Recursive dependency: %s -> %s" % (
                     " -> ".join(targetstack), self.target))
 
@@ -926,15 +1377,20 @@ class Target(object):
         if recursive:
             for r in self.rules:
                 newrulestack = rulestack + [r]
-                for d in r.prerequisites:
-                    dt = makefile.gettarget(d)
+                for dt in makefile.graph.ruletargets(r):
                     if dt.explicit:
                         continue
 
                     dt.resolvedeps(makefile, targetstack, newrulestack, True)
 
-        for v in makefile.getpatternvariablesfor(self.target):
-            self.variables.merge(v)
+        if not self.patternvariablesapplied:
+            # Pattern-specific variables sit between the target-specific variables and their
+            # parent, the most recently defined pattern nearest the target
+            parent = self.variables.parent
+            for v in makefile.getpatternvariablesfor(self.target):
+                parent = v.overlay(parent)
+            self.variables.parent = parent
+            self.patternvariablesapplied = True
 
     def resolvevpath(self, makefile):
         if self.vpathtarget is not None:
@@ -975,8 +1431,11 @@ class Target(object):
 
         search = [self.target]
         if not os.path.isabs(self.target):
+            dirs = makefile.getvpath(self.target)
+            if len(dirs) and self.target.find('/') == -1:
+                dirs = makefile.getvpathindex(dirs).get(self.target)
             search += [util.normaljoin(dir, self.target).replace('\\', '/')
-                       for dir in makefile.getvpath(self.target)]
+                       for dir in dirs]
 
         for t in search:
             fspath = util.normaljoin(makefile.workdir, t).replace('\\', '/')
@@ -990,12 +1449,15 @@ class Target(object):
         self.vpathtarget = self.target
         self.mtime = None
         
-    def beingremade(self):
+    def beingremade(self, makefile):
         """
-        When we remake ourself, we need to reset our mtime and vpathtarget.
+        When we remake ourself, we need to reset our mtime and vpathtarget, and forget
+        anything the filesystem cache knows about the old and new paths.
 
         We store our old mtime so that $? can calculate out-of-date prerequisites.
         """
+        fscache.invalidate(util.normaljoin(makefile.workdir, self.vpathtarget))
+        fscache.invalidate(util.normaljoin(makefile.workdir, self.target))
         self.realmtime = self.mtime
         self.mtime = None
         self.vpathtarget = self.target
@@ -1064,13 +1526,13 @@ class Target(object):
             return
 
         if self.isdoublecolon():
-            rulelist = [RemakeRuleContext(self, makefile, r, [(makefile.gettarget(p), False) for p in r.prerequisites], targetstack, avoidremakeloop) for r in self.rules]
+            rulelist = [RemakeRuleContext(self, makefile, r, [(t, False) for t in makefile.graph.ruletargets(r)], targetstack, avoidremakeloop) for r in self.rules]
         else:
             alldeps = []
 
             commandrule = None
             for r in self.rules:
-                rdeps = [(makefile.gettarget(p), r.weakdeps) for p in r.prerequisites]
+                rdeps = [(t, r.weakdeps) for t in makefile.graph.ruletargets(r)]
                 if len(r.commands):
                     assert commandrule is None
                     commandrule = r
@@ -1105,8 +1567,7 @@ def setautomatic(v, name, plist):
     v.set(name + 'D', Variables.FLAVOR_SIMPLE, Variables.SOURCE_AUTOMATIC, ' '.join((dirpart(p) for p in plist)))
     v.set(name + 'F', Variables.FLAVOR_SIMPLE, Variables.SOURCE_AUTOMATIC, ' '.join((filepart(p) for p in plist)))
 
-def setautomaticvariables(v, makefile, target, prerequisites):
-    prtargets = [makefile.gettarget(p) for p in prerequisites]
+def setautomaticvariables(v, makefile, target, prtargets):
     prall = [pt.vpathtarget for pt in prtargets]
     proutofdate = [pt.vpathtarget for pt in withoutdups(prtargets)
                    if target.realmtime is None or mtimeislater(pt.mtime, target.realmtime)]
@@ -1156,6 +1617,9 @@ def findmodifiers(command):
     return realcommand, '@' in modset, '+' in modset, '-' in modset, '%' in modset
 
 class _CommandWrapper(object):
+    starttime = None
+    duration = 0.0 # seconds the command ran for, not counting time waiting for a job slot
+
     def __init__(self, cline, ignoreErrors, loc, context, **kwargs):
         self.ignoreErrors = ignoreErrors
         self.loc = loc
@@ -1163,7 +1627,17 @@ class _CommandWrapper(object):
         self.kwargs = kwargs
         self.context = context
 
+    def _started(self):
+        self.starttime = time.time()
+
     def _cb(self, res):
+        self.res = res
+        if self.starttime is not None:
+            self.duration = time.time() - self.starttime
+
+        # The command may have created or deleted any file
+        fscache.clear()
+
         if res != 0 and not self.ignoreErrors:
             print "%s: command '%s' failed, return code %i" % (self.loc, self.cline, res)
             self.usercb(error=True)
@@ -1172,7 +1646,8 @@ class _CommandWrapper(object):
 
     def __call__(self, cb):
         self.usercb = cb
-        process.call(self.cline, loc=self.loc, cb=self._cb, context=self.context, **self.kwargs)
+        process.call(self.cline, loc=self.loc, cb=self._cb, context=self.context,
+                     startcb=self._started, **self.kwargs)
 
 class _NativeWrapper(_CommandWrapper):
     def __init__(self, cline, ignoreErrors, loc, context,
@@ -1198,16 +1673,22 @@ class _NativeWrapper(_CommandWrapper):
         self.usercb = cb
         process.call_native(self.module, self.method, self.cline_list,
                             loc=self.loc, cb=self._cb, context=self.context,
-                            pycommandpath=self.pycommandpath, **self.kwargs)
+                            pycommandpath=self.pycommandpath, startcb=self._started,
+                            **self.kwargs)
 
-def getcommandsforrule(rule, target, makefile, prerequisites, stem):
+def getcommandsforrule(rule, target, makefile, stem):
     v = Variables(parent=target.variables)
-    setautomaticvariables(v, makefile, target, prerequisites)
+    setautomaticvariables(v, makefile, target, makefile.graph.ruletargets(rule))
     if stem is not None:
         setautomatic(v, '*', [stem])
 
     env = makefile.getsubenvironment(v)
 
+    if makefile.context.jcount > 1:
+        priority = makefile.graph.getpriority(target)
+    else:
+        priority = 0
+
     for c in rule.commands:
         cstring = c.resolvestr(makefile, v)
         for cline in splitcommand(cstring):
@@ -1218,7 +1699,7 @@ def getcommandsforrule(rule, target, makefile, prerequisites, stem):
                 echo = "%s$ %s" % (c.loc, cline)
             if not isNative:
                 yield _CommandWrapper(cline, ignoreErrors=ignoreErrors, env=env, cwd=makefile.workdir, loc=c.loc, context=makefile.context,
-                                      echo=echo, justprint=makefile.justprint)
+                                      echo=echo, justprint=makefile.justprint, priority=priority)
             else:
                 f, s, e = v.get("PYCOMMANDPATH", True)
                 if e:
@@ -1227,7 +1708,7 @@ def getcommandsforrule(rule, target, makefile, prerequisites, stem):
                                      env=env, cwd=makefile.workdir,
                                      loc=c.loc, context=makefile.context,
                                      echo=echo, justprint=makefile.justprint,
-                                     pycommandpath=e)
+                                     pycommandpath=e, priority=priority)
 
 class Rule(object):
     """
@@ -1236,7 +1717,8 @@ class Rule(object):
     """
 
     def __init__(self, prereqs, doublecolon, loc, weakdeps):
-        self.prerequisites = prereqs
+        self.prerequisites = [intern(p) for p in prereqs]
+        self.prereqids = None
         self.doublecolon = doublecolon
         self.commands = []
         self.loc = loc
@@ -1249,7 +1731,7 @@ class Rule(object):
     def getcommands(self, target, makefile):
         assert isinstance(target, Target)
 
-        return getcommandsforrule(self, target, makefile, self.prerequisites, stem=None)
+        return getcommandsforrule(self, target, makefile, stem=None)
         # TODO: $* in non-pattern rules?
 
 class PatternRuleInstance(object):
@@ -1266,6 +1748,7 @@ class PatternRuleInstance(object):
         self.stem = stem
         self.prule = prule
         self.prerequisites = prule.prerequisitesforstem(dir, stem)
+        self.prereqids = None
         self.doublecolon = prule.doublecolon
         self.loc = prule.loc
         self.ismatchany = ismatchany
@@ -1273,7 +1756,7 @@ class PatternRuleInstance(object):
 
     def getcommands(self, target, makefile):
         assert isinstance(target, Target)
-        return getcommandsforrule(self, target, makefile, self.prerequisites, stem=self.dir + self.stem)
+        return getcommandsforrule(self, target, makefile, stem=self.dir + self.stem)
 
     def __str__(self):
         return "Pattern rule at %s with stem '%s', matchany: %s doublecolon: %s" % (self.loc,
@@ -1301,37 +1784,57 @@ class PatternRule(object):
     def ismatchany(self):
         return util.any((t.ismatchany() for t in self.targetpatterns))
 
-    def hasspecificmatch(self, file):
-        for p in self.targetpatterns:
-            if not p.ismatchany() and p.match(file) is not None:
-                return True
+    def prerequisitesforstem(self, dir, stem):
+        return [intern(p.resolve(dir, stem)) for p in self.prerequisites]
 
-        return False
+class PatternIndex(object):
+    """
+    An index of Patterns, each with an associated value, by the text which follows the '%' (or
+    the whole text, for a Pattern without '%'). It finds the patterns which may match a word by
+    looking up each distinct suffix length instead of trying every pattern.
+    """
+
+    __slots__ = ('_bysuffix', '_lengths', '_seq')
+
+    def __init__(self):
+        self._bysuffix = {} # suffix -> [(seq, pattern, value), ...]
+        self._lengths = [] # distinct suffix lengths, sorted
+        self._seq = 0
 
-    def matchesfor(self, dir, file, skipsinglecolonmatchany):
+    def add(self, pattern, value):
+        suffix = pattern.data[-1]
+        entry = (self._seq, pattern, value)
+        self._seq += 1
+
+        l = self._bysuffix.get(suffix, None)
+        if l is None:
+            self._bysuffix[suffix] = [entry]
+            if len(suffix) not in self._lengths:
+                self._lengths.append(len(suffix))
+                self._lengths.sort()
+        else:
+            l.append(entry)
+
+    def candidates(self, word):
         """
-        Determine all the target patterns of this rule that might match target t.
-        @yields a PatternRuleInstance for each.
+        Get the entries whose pattern has the same suffix as `word`, as a list of
+        (seq, pattern, value) in the order they were added. The prefix of a pattern isn't
+        checked: the caller must still match each pattern against `word`.
         """
+        r = []
+        wlen = len(word)
+        for l in self._lengths:
+            if l > wlen:
+                break
+            entries = self._bysuffix.get(word[wlen - l:], None)
+            if entries is not None:
+                r.extend(entries)
 
-        for p in self.targetpatterns:
-            matchany = p.ismatchany()
-            if matchany:
-                if skipsinglecolonmatchany and not self.doublecolon:
-                    continue
+        r.sort()
+        return r
 
-                yield PatternRuleInstance(self, dir, file, True)
-            else:
-                stem = p.match(dir + file)
-                if stem is not None:
-                    yield PatternRuleInstance(self, '', stem, False)
-                else:
-                    stem = p.match(file)
-                    if stem is not None:
-                        yield PatternRuleInstance(self, dir, stem, False)
-
-    def prerequisitesforstem(self, dir, stem):
-        return [p.resolve(dir, stem) for p in self.prerequisites]
+    def __len__(self):
+        return self._seq
 
 class _RemakeContext(object):
     def __init__(self, makefile, cb):
@@ -1364,6 +1867,207 @@ class _RemakeContext(object):
 
             self.cb(remade=False)
 
+class _VPathIndex(object):
+    """
+    An index from file names to the directories of a VPATH search list which contain them, built
+    from one listing of each directory. Like GNU make's directory cache, it doesn't see files
+    created in those directories by commands, except for targets which are remade: those
+    invalidate the index through fscache.watchgeneration.
+    """
+
+    __slots__ = ('dirs', 'generation', '_names')
+
+    def __init__(self, workdir, dirs):
+        self.dirs = dirs
+        self.generation = fscache.watchgeneration
+        self._names = {} # file name -> [dir, ...]
+
+        for dir in dirs:
+            fsdir = util.normaljoin(workdir, dir)
+            fscache.watch(fsdir)
+            names = fscache.listdir(fsdir)
+            if names is None:
+                continue
+            for name in names:
+                if fscache.casefold:
+                    name = name.lower()
+                l = self._names.get(name, None)
+                if l is None:
+                    self._names[name] = [dir]
+                else:
+                    l.append(dir)
+
+    def get(self, name):
+        """
+        The directories containing `name`, in search order.
+        """
+        if fscache.casefold:
+            name = name.lower()
+        return self._names.get(name, ())
+
+class DependencyGraph(object):
+    """
+    The dependency graph of a makefile, built when parsing is finished. Every Target is a node
+    with a small integer id, Target.nodeid: nodes[id] is the Target, prerequisites[id] and
+    dependents[id] are the ids of its prerequisites (from all of its rules) and of the targets
+    which list it as a prerequisite, and flags[id] is a combination of the FLAG_ bits. The
+    prerequisite ids of each rule are kept in rule.prereqids.
+
+    Targets created after the graph is built, such as the prerequisites of implicit rules, are
+    added as they are created, and so are the edges of the implicit rule chosen for a target.
+    """
+
+    FLAG_EXPLICIT = 1
+    FLAG_PHONY = 2
+    FLAG_DOUBLECOLON = 4
+
+    __slots__ = ('makefile', 'nodes', 'prerequisites', 'dependents', 'flags', '_phony',
+                 '_priorities')
+
+    def __init__(self, makefile, phony):
+        self.makefile = makefile
+        self.nodes = []
+        self.prerequisites = []
+        self.dependents = []
+        self.flags = []
+        self._phony = phony
+        self._priorities = {} # node id -> priority
+
+    def addnode(self, t):
+        assert t.nodeid is None
+        t.nodeid = len(self.nodes)
+        self.nodes.append(t)
+        self.prerequisites.append([])
+        self.dependents.append([])
+
+        flags = 0
+        if t.explicit:
+            flags |= self.FLAG_EXPLICIT
+        if t.target in self._phony:
+            flags |= self.FLAG_PHONY
+        self.flags.append(flags)
+
+    def setexplicit(self, t):
+        t.explicit = True
+        self.flags[t.nodeid] |= self.FLAG_EXPLICIT
+
+    def addrule(self, t, rule):
+        """
+        Add the edges from `t` to the prerequisites of `rule`, which has been added to t.rules.
+        """
+        id = t.nodeid
+        if t.rules[0] is rule and rule.doublecolon:
+            self.flags[id] |= self.FLAG_DOUBLECOLON
+
+        ids = self.ruleprerequisites(rule)
+        self.prerequisites[id].extend(ids)
+        for p in ids:
+            self.dependents[p].append(id)
+
+    def removerule(self, t, rule):
+        """
+        Remove the edges added by addrule(t, rule). `rule` must already have been removed from
+        t.rules.
+        """
+        id = t.nodeid
+        if not len(t.rules):
+            self.flags[id] &= ~self.FLAG_DOUBLECOLON
+
+        for p in self.ruleprerequisites(rule):
+            self.prerequisites[id].remove(p)
+            self.dependents[p].remove(id)
+
+    def resetpriorities(self):
+        self._priorities.clear()
+
+    def ruleprerequisites(self, rule):
+        """
+        The node ids of the prerequisites of `rule`, in order.
+        """
+        ids = rule.prereqids
+        if ids is None:
+            gettarget = self.makefile.gettarget
+            ids = [gettarget(p).nodeid for p in rule.prerequisites]
+            rule.prereqids = ids
+        return ids
+
+    def ruletargets(self, rule):
+        """
+        The prerequisite Targets of `rule`, in order.
+        """
+        nodes = self.nodes
+        return [nodes[p] for p in self.ruleprerequisites(rule)]
+
+    def downstream(self, ids):
+        """
+        The set of the node ids `ids` and of every node which depends on them, directly or
+        indirectly.
+        """
+        seen = set(ids)
+        stack = list(seen)
+        dependents = self.dependents
+        while len(stack):
+            for d in dependents[stack.pop()]:
+                if d not in seen:
+                    seen.add(d)
+                    stack.append(d)
+        return seen
+
+    def estimatecost(self, t):
+        """
+        Estimate how long remaking `t` takes, using Makefile.estimateduration if it is set and
+        knows the target, or else counting each of its commands as 1.
+        """
+        estimate = self.makefile.estimateduration
+        if estimate is not None:
+            d = estimate(t)
+            if d is not None:
+                return d
+
+        return sum(len(r.commands) for r in t.rules)
+
+    def getpriority(self, t):
+        """
+        The scheduling priority of the commands of `t`: the estimated cost of the longest path
+        from `t` through the targets which depend on it. Priorities are computed when first
+        asked for and kept, so edges added later don't change them.
+        """
+        priorities = self._priorities
+        p = priorities.get(t.nodeid, None)
+        if p is not None:
+            return p
+
+        visiting = set()
+        stack = [(t.nodeid, False)]
+        while len(stack):
+            id, expanded = stack.pop()
+            if id in priorities:
+                continue
+
+            dependents = self.dependents[id]
+            if expanded:
+                priorities[id] = self.estimatecost(self.nodes[id]) + max([priorities.get(d, 0) for d in dependents] or [0])
+                continue
+
+            if id in visiting:
+                # a dependency cycle
+                continue
+
+            visiting.add(id)
+            stack.append((id, True))
+            for d in dependents:
+                if d not in priorities and d not in visiting:
+                    stack.append((d, False))
+
+        return priorities[t.nodeid]
+
+# Targets with a special meaning to GNU make or pymake. Only .PHONY, .NOTPARALLEL and
+# .PYMAKE_CACHEABLE affect pymake.
+_specialtargets = frozenset(('.PHONY', '.SUFFIXES', '.DEFAULT', '.PRECIOUS', '.INTERMEDIATE',
+                             '.SECONDARY', '.SECONDEXPANSION', '.DELETE_ON_ERROR', '.IGNORE',
+                             '.LOW_RESOLUTION_TIME', '.SILENT', '.EXPORT_ALL_VARIABLES',
+                             '.NOTPARALLEL', '.ONESHELL', '.POSIX', '.PYMAKE_CACHEABLE'))
+
 class Makefile(object):
     """
     The top-level data structure for makefile execution. It holds Targets, implicit rules, and other
@@ -1373,7 +2077,8 @@ class Makefile(object):
     def __init__(self, workdir=None, env=None, restarts=0, make=None,
                  makeflags='', makeoverrides='',
                  makelevel=0, context=None, targets=(), keepgoing=False,
-                 silent=False, justprint=False):
+                 silent=False, justprint=False, statedb=None, contenthash=False,
+                 commandsignatures=False, outputcache=None):
         self.defaulttarget = None
 
         if env is None:
@@ -1385,15 +2090,65 @@ class Makefile(object):
 
         self.context = context
         self.exportedvars = {}
+        self._subenv = None # (environment, [(vname, names referenced or None), ...])
+        self._pyfunctions = None # (value of .PYMAKE_FUNCTIONS, {name: function})
         self._targets = {}
         self.keepgoing = keepgoing
         self.silent = silent
         self.justprint = justprint
-        self._patternvariables = [] # of (pattern, variables)
+
+        # What parsing read besides makefiles: the output of each $(shell) command, and the
+        # result of each $(wildcard) pattern
+        self.parseshells = [] # of (command, output)
+        self.parsewildcards = {} # pattern -> list of paths
+
+        # With -q, stop with an error at the first target which would be remade, and set
+        # outofdate. Set once makefiles have been remade.
+        self.question = False
+        self.outofdate = False
+        self._patternvariables = {} # pattern -> Variables
+        self.patternvariableindex = PatternIndex() # pattern -> Variables
         self.implicitrules = []
+        self.implicitruleindex = PatternIndex() # target pattern -> PatternRule
+        self._implicitmemo = {} # (dir, file, frozenset of PatternRules) -> candidate or None
+        self._implicitmemogeneration = None
+        self.implicitsearches = 0
+        self.implicitmemohits = 0
+        self.recursivedeps = 0 # recursive dependencies found by Target.resolvedeps
         self.parsingfinished = False
+        self.graph = None
+
+        # Computed by finishparsing: the names of phony targets, of targets whose output may
+        # be cached, and of the special targets which have rules
+        self.phonytargets = None
+        self.cacheabletargets = None
+        self.specialtargets = None
+
+        # function(target) -> estimated seconds to remake the target, or None if unknown. Used
+        # to prioritize jobs on the critical path.
+        self.estimateduration = None
+
+        self.statedb = statedb
+        if statedb is not None:
+            self.estimateduration = self._statedbestimate
+
+        # Whether to skip remaking targets whose prerequisites are newer but have the same
+        # contents as when the target was last remade. Requires a statedb.
+        assert statedb is not None or not contenthash
+        self.contenthash = contenthash
+
+        # Whether to remake targets whose expanded commands changed since they were last
+        # remade. This expands the commands of every target considered. Requires a statedb.
+        assert statedb is not None or not commandsignatures
+        self.commandsignatures = commandsignatures
+
+        # A buildcache.OutputCache of the files made by rules. Requires a statedb.
+        assert statedb is not None or outputcache is None
+        self.outputcache = outputcache
 
         self._patternvpaths = [] # of (pattern, [dir, ...])
+        self._vpathcache = {} # target -> (dir, ...)
+        self._vpathindexes = {} # (dir, ...) -> _VPathIndex
 
         if workdir is None:
             workdir = os.getcwd()
@@ -1450,16 +2205,19 @@ class Makefile(object):
     def getpatternvariables(self, pattern):
         assert isinstance(pattern, Pattern)
 
-        for p, v in self._patternvariables:
-            if p == pattern:
-                return v
-
-        v = Variables()
-        self._patternvariables.append( (pattern, v) )
+        v = self._patternvariables.get(pattern, None)
+        if v is None:
+            v = Variables(parent=self.variables)
+            self._patternvariables[pattern] = v
+            self.patternvariableindex.add(pattern, v)
         return v
 
     def getpatternvariablesfor(self, target):
-        for p, v in self._patternvariables:
+        """
+        Yield the pattern-specific Variables matching `target`, in the order their patterns
+        were first used.
+        """
+        for seq, p, v in self.patternvariableindex.candidates(target):
             if p.match(target):
                 yield v
 
@@ -1469,6 +2227,11 @@ class Makefile(object):
     def gettarget(self, target):
         assert isinstance(target, str)
 
+        # Most lookups are for names which are already known, and so already normalized
+        t = self._targets.get(target, None)
+        if t is not None:
+            return t
+
         target = target.rstrip('/')
 
         assert target != '', "empty target?"
@@ -1478,13 +2241,20 @@ class Makefile(object):
 
         t = self._targets.get(target, None)
         if t is None:
+            # Target names are interned so that the many references to them from rules share a
+            # single string, and so that dict lookups with them compare by identity.
+            target = intern(target)
             t = Target(target, self)
             self._targets[target] = t
+            if self.graph is not None:
+                self.graph.addnode(t)
         return t
 
     def appendimplicitrule(self, rule):
         assert isinstance(rule, PatternRule)
         self.implicitrules.append(rule)
+        for p in rule.targetpatterns:
+            self.implicitruleindex.add(p, rule)
 
     def finishparsing(self):
         """
@@ -1506,20 +2276,89 @@ class Makefile(object):
             self._vpath = filter(lambda e: e != '',
                                  re.split('[%s\s]+' % os.pathsep,
                                           value.resolvestr(self, self.variables, ['VPATH'])))
+        self._vpathcache.clear()
+
+        phony = set()
+        if self.hastarget('.PHONY'):
+            for r in self._targets['.PHONY'].rules:
+                phony.update(r.prerequisites)
+        self.phonytargets = frozenset(phony)
+
+        cacheable = set()
+        if self.hastarget('.PYMAKE_CACHEABLE'):
+            for r in self._targets['.PYMAKE_CACHEABLE'].rules:
+                cacheable.update(r.prerequisites)
+        self.cacheabletargets = frozenset(cacheable)
+        self.specialtargets = frozenset(t for t in _specialtargets
+                                        if t in self._targets and len(self._targets[t].rules))
 
         targets = list(self._targets.itervalues())
+        self.graph = DependencyGraph(self, self.phonytargets)
         for t in targets:
             t.explicit = True
+            self.graph.addnode(t)
+
+        for t in targets:
             for r in t.rules:
-                for p in r.prerequisites:
-                    self.gettarget(p).explicit = True
+                self.graph.addrule(t, r)
+                for p in self.graph.ruleprerequisites(r):
+                    self.graph.setexplicit(self.graph.nodes[p])
 
-        np = self.gettarget('.NOTPARALLEL')
-        if len(np.rules):
+        if '.NOTPARALLEL' in self.specialtargets:
             self.context = process.getcontext(1)
 
         self.error = False
 
+    def getpythonfunction(self, name):
+        """
+        Get the Python function `name` exported by one of the modules listed in the
+        .PYMAKE_FUNCTIONS variable, or None. The modules are loaded from sys.path and the
+        directories in PYCOMMANDPATH. A module registers the names in its __all__, or all of its
+        public functions if it doesn't have __all__.
+        """
+        flavor, source, value = self.variables.get('.PYMAKE_FUNCTIONS')
+        if value is None:
+            return None
+
+        modules = value.resolvestr(self, self.variables, ['.PYMAKE_FUNCTIONS'])
+        if self._pyfunctions is None or self._pyfunctions[0] != modules:
+            self._pyfunctions = modules, self._loadpythonfunctions(modules.split())
+
+        return self._pyfunctions[1].get(name, None)
+
+    def _loadpythonfunctions(self, modules):
+        path = list(sys.path)
+        flavor, source, value = self.variables.get('PYCOMMANDPATH')
+        if value is not None:
+            path.extend(util.normaljoin(self.workdir, dir)
+                        for dir in re.split('[%s\s]+' % os.pathsep,
+                                            value.resolvestr(self, self.variables, ['PYCOMMANDPATH']))
+                        if dir != '')
+
+        funcs = {}
+        for module in modules:
+            if module not in sys.modules:
+                process.load_module_recursive(module, path)
+            if module not in sys.modules:
+                raise DataError("No module named '%s' in .PYMAKE_FUNCTIONS" % (module,))
+
+            m = sys.modules[module]
+            names = getattr(m, '__all__', None)
+            if names is None:
+                names = [n for n, f in m.__dict__.iteritems()
+                         if not n.startswith('_') and isinstance(f, types.FunctionType)
+                         and f.__module__ == m.__name__]
+
+            for n in names:
+                try:
+                    f = getattr(m, n)
+                except AttributeError:
+                    raise DataError("Module '%s' in .PYMAKE_FUNCTIONS lists '%s' in __all__, but doesn't define it" % (module, n))
+                if callable(f):
+                    funcs[n] = f
+
+        return funcs
+
     def include(self, path, required=True, weak=False, loc=None):
         """
         Include the makefile at `path`.
@@ -1537,6 +2376,7 @@ class Makefile(object):
         Add a directory to the vpath search for the given pattern.
         """
         self._patternvpaths.append((pattern, dirs))
+        self._vpathcache.clear()
 
     def clearvpath(self, pattern):
         """
@@ -1545,23 +2385,163 @@ class Makefile(object):
         self._patternvpaths = [(p, dirs)
                                for p, dirs in self._patternvpaths
                                if not p.match(pattern)]
+        self._vpathcache.clear()
 
     def clearallvpaths(self):
         self._patternvpaths = []
+        self._vpathcache.clear()
 
     def getvpath(self, target):
+        """
+        Get the tuple of directories to search for `target`. Once parsing is finished the
+        result for each target is kept.
+        """
+        vp = self._vpathcache.get(target, None)
+        if vp is not None:
+            return vp
+
         vp = list(self._vpath)
         for p, dirs in self._patternvpaths:
             if p.match(target):
                 vp.extend(dirs)
 
-        return withoutdups(vp)
+        vp = tuple(withoutdups(vp))
+        if self.parsingfinished:
+            self._vpathcache[target] = vp
+        return vp
+
+    def getvpathindex(self, dirs):
+        """
+        Get the _VPathIndex for the tuple of directories `dirs`.
+        """
+        index = self._vpathindexes.get(dirs, None)
+        if index is None or index.generation != fscache.watchgeneration:
+            index = _VPathIndex(self.workdir, dirs)
+            self._vpathindexes[dirs] = index
+        return index
+
+    def getimplicitmemo(self):
+        """
+        Get the dict of remembered implicit rule searches. Their results depend on which files
+        exist, so it is emptied whenever the filesystem cache is invalidated.
+        """
+        if self._implicitmemogeneration != fscache.generation:
+            self._implicitmemo.clear()
+            self._implicitmemogeneration = fscache.generation
+        return self._implicitmemo
+
+    def getstatedbpath(self, t):
+        """
+        The name of target `t` in the build-state database: its absolute path.
+        """
+        return util.normaljoin(self.workdir, t.target)
+
+    def _statedbestimate(self, t):
+        return self.statedb.estimateduration(self.getstatedbpath(t))
+
+    def resetbuildstate(self):
+        """
+        Forget the results of making any targets, so that this makefile can be used for another
+        build. The filesystem cache should be reset first.
+        """
+        for t in self._targets.itervalues():
+            t.resetstate(self)
+
+        self.graph.resetpriorities()
+        self._implicitmemo.clear()
+        self.error = False
+        self.question = False
+        self.outofdate = False
+
+    def watchpaths(self):
+        """
+        The filesystem paths of the makefiles and of every target which isn't phony.
+        """
+        for t in self.graph.nodes:
+            if not self.graph.flags[t.nodeid] & DependencyGraph.FLAG_PHONY:
+                for path in t.fspaths(self):
+                    yield path
+
+    def resetchanged(self, paths):
+        """
+        Forget the results of making the targets at the filesystem `paths`, which have changed,
+        and every target which depends on them, so that making the same targets again only
+        remakes what is affected. A path which is a directory stands for everything in it.
+        Targets which failed or were still being made are reset too. Returns the list of
+        targets which were reset.
+        """
+        for path in paths:
+            fscache.invalidate(path)
+
+        ids = []
+        for t in self.graph.nodes:
+            if t._state == MAKESTATE_WORKING or (t._state == MAKESTATE_FINISHED and t.error):
+                ids.append(t.nodeid)
+                continue
+
+            for path in t.fspaths(self):
+                if path in paths or os.path.dirname(path) in paths:
+                    fscache.invalidate(path)
+                    ids.append(t.nodeid)
+                    break
+
+        reset = [self.graph.nodes[id] for id in self.graph.downstream(ids)]
+        for t in reset:
+            t.resetstate(self)
+
+        self.graph.resetpriorities()
+        self.error = False
+        self.outofdate = False
+        return reset
+
+    def parseinputschanged(self):
+        """
+        Check whether anything parsing read besides the makefiles themselves has changed: a
+        $(wildcard) or a glob in a rule's targets or prerequisites now has a different result, or
+        a $(shell) command prints something different. The $(shell) commands are run again to
+        find out.
+        """
+        for pattern, result in self.parsewildcards.iteritems():
+            if glob(self.workdir, pattern) != result:
+                return True
+
+        for cline, output in self.parseshells:
+            if functions.runshell(self, cline) != output:
+                return True
+
+        return False
+
+    def __getstate__(self):
+        """
+        Makefiles are pickled by snapshots without the state belonging to the make using them:
+        see attach().
+        """
+        state = self.__dict__.copy()
+        for name in ('env', 'context', 'statedb', 'outputcache', 'estimateduration'):
+            state[name] = None
+        state['_subenv'] = None
+        state['_pyfunctions'] = None
+        state['_implicitmemo'] = {}
+        state['_implicitmemogeneration'] = None
+        return state
+
+    def attach(self, env, context, statedb, outputcache):
+        """
+        Give an unpickled makefile the state of the make which will use it.
+        """
+        self.env = env
+        self.variables.readfromenvironment(env)
+        self.context = context
+        self.statedb = statedb
+        if statedb is not None:
+            self.estimateduration = self._statedbestimate
+        self.outputcache = outputcache
 
     def remakemakefiles(self, cb):
         mlist = []
         for f, required in self.included:
             t = self.gettarget(f)
-            t.explicit = True
+            self.graph.setexplicit(t)
             t.resolvevpath(self)
             oldmtime = t.mtime
 
@@ -1569,20 +2549,90 @@ class Makefile(object):
 
         _RemakeContext(self, cb)
 
-    def getsubenvironment(self, variables):
+    def _getexportedvalue(self, vname, variables):
+        flavor, source, val = variables.get(vname)
+        if val is None:
+            return ''
+        return val.resolvestr(self, variables, [vname])
+
+    def _getexportrefs(self, vname, refs):
+        """
+        Add to `refs` the names of the variables which the global value of `vname` refers to,
+        directly or indirectly. Returns False if the value can't be known without resolving it
+        in a particular scope, because it calls a function or computes a variable name.
+        """
+        if vname in refs:
+            return True
+        refs.add(vname)
+
+        flavor, source, value = self.variables.get(vname)
+        if value is None or value.simple:
+            return True
+
+        for e, isfunc in value:
+            if not isfunc:
+                continue
+            if not isinstance(e, (functions.VariableRef, functions.SubstitutionRef)):
+                return False
+            if not e.vname.simple:
+                return False
+            if isinstance(e, functions.SubstitutionRef) and not (e.substfrom.simple and e.substto.simple):
+                return False
+            if not self._getexportrefs(e.vname.s, refs):
+                return False
+
+        return True
+
+    def _getbasesubenvironment(self, variables):
         env = dict(self.env)
+        exportrefs = []
         for vname, v in self.exportedvars.iteritems():
             if v:
-                flavor, source, val = variables.get(vname)
-                if val is None:
-                    strval = ''
-                else:
-                    strval = val.resolvestr(self, variables, [vname])
-                env[vname] = strval
+                env[vname] = self._getexportedvalue(vname, variables)
+                refs = set()
+                if not self._getexportrefs(vname, refs):
+                    refs = None
+                exportrefs.append((vname, refs))
             else:
                 env.pop(vname, None)
 
-        makeflags = ''
-
         env['MAKELEVEL'] = str(self.makelevel + 1)
+        return env, exportrefs
+
+    def getsubenvironment(self, variables):
+        """
+        Get the environment for commands run with `variables`. Once parsing is finished the
+        exported values are resolved once in the global scope, and an exported variable is
+        resolved again only if `variables` (or a scope between it and the global variables)
+        overrides something its value refers to. The returned dict may be shared and must not
+        be modified.
+        """
+        if not self.parsingfinished:
+            # Exports may still change, so nothing is kept
+            return self._getbasesubenvironment(variables)[0]
+
+        if self._subenv is None:
+            self._subenv = self._getbasesubenvironment(self.variables)
+        baseenv, exportrefs = self._subenv
+
+        overridden = set()
+        scope = variables
+        while scope is not None and scope is not self.variables:
+            overridden.update(scope._map)
+            scope = scope.parent
+
+        if not overridden:
+            return baseenv
+
+        env = baseenv
+        for vname, refs in exportrefs:
+            if refs is not None and overridden.isdisjoint(refs):
+                continue
+
+            strval = self._getexportedvalue(vname, variables)
+            if strval != env[vname]:
+                if env is baseenv:
+                    env = dict(baseenv)
+                env[vname] = strval
+
         return env
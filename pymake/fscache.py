@@ -0,0 +1,219 @@
+"""
+A process-wide cache of filesystem state.
+
+Directory listings and the results of stat() are cached so that $(wildcard), globbing in rule
+targets and prerequisites, and globbing of native command arguments don't list and stat the same
+directories over and over. Every makefile executing in this process shares the cache.
+
+The cache never notices changes on its own; it must be invalidated explicitly:
+
+* when a target is remade, its path and the listing of its directory are forgotten
+* when a command or $(shell) finishes, everything is forgotten, since those may have created
+  or removed arbitrary files
+
+File modification times used to decide whether targets are out of date are cached separately
+by getmtime, and are invalidated more precisely: only when the target at a path is remade, or
+when the commands remaking it finish. Every makefile in the process, including in-process
+submakes, shares them. A file changed as a side effect of a command which isn't remaking it
+keeps its old modification time, as GNU make does within a single make.
+
+With `scandirs` set, getmtime answers whether a file exists from the cached listing of its
+directory, and only stats files which exist. Looking up many missing files in one directory
+then costs a single listdir.
+
+Directories can also be watched, for indexes built from their listings which should outlive
+clear(), such as the VPATH index: `watchgeneration` changes whenever a watched directory, or a
+path in one, is invalidated. `generation` changes whenever anything at all is invalidated or
+cleared, for results which depend on the state of arbitrary files.
+"""
+
+import os, re, fnmatch, posixpath, stat, sys
+
+_listings = {} # normalized directory path -> list of leaf names, or None if not a directory
+_stats = {} # normalized path -> os.stat result, or None if the path doesn't exist
+_patterns = {} # fnmatch pattern -> compiled match function
+_mtimes = {} # normalized path -> st_mtime, or None if the path doesn't exist
+_namesets = {} # normalized directory path -> set of (case-folded) leaf names
+
+# Use directory listings to find missing files in getmtime
+scandirs = False
+
+# Filesystems which are usually case-insensitive
+casefold = sys.platform in ('win32', 'darwin', 'cygwin')
+
+_watched = set() # normalized directory paths
+watchgeneration = 0
+generation = 0
+
+# counters for getmtime: stat calls issued, and results served from the cache
+mtimesissued = 0
+mtimesserved = 0
+
+def _key(path):
+    return os.path.normpath(path)
+
+def listdir(dir):
+    """
+    Return the leaf names in `dir`, or None if it is not a directory. '.' and '..' are not
+    included. The returned list is shared and must not be modified.
+    """
+    key = _key(dir)
+    try:
+        return _listings[key]
+    except KeyError:
+        pass
+
+    try:
+        names = os.listdir(key)
+    except OSError:
+        names = None
+
+    _listings[key] = names
+    return names
+
+def _stat(key):
+    try:
+        return _stats[key]
+    except KeyError:
+        pass
+
+    try:
+        st = os.stat(key)
+    except OSError:
+        st = None
+
+    _stats[key] = st
+    return st
+
+def exists(path):
+    """
+    Does `path` exist? Like os.path.exists, symlinks are followed, so a dangling link doesn't exist.
+    """
+    return _stat(_key(path)) is not None
+
+def isdir(path):
+    st = _stat(_key(path))
+    return st is not None and stat.S_ISDIR(st.st_mode)
+
+def fnmatchfilter(names, pattern):
+    """
+    Equivalent to fnmatch.filter, except that compiled patterns are kept for the life of the
+    process instead of in fnmatch's small, periodically purged cache.
+    """
+    match = _patterns.get(pattern, None)
+    if match is None:
+        match = re.compile(fnmatch.translate(os.path.normcase(pattern))).match
+        _patterns[pattern] = match
+
+    if os.path is posixpath:
+        return [name for name in names if match(name)]
+
+    return [name for name in names if match(os.path.normcase(name))]
+
+def _inlisting(key):
+    dir, leaf = os.path.split(key)
+    if leaf in ('', '.', '..'):
+        return True
+    if dir == '':
+        dir = '.'
+
+    names = _namesets.get(dir, None)
+    if names is None:
+        listing = listdir(dir)
+        if listing is None:
+            names = ()
+        elif casefold:
+            names = set(name.lower() for name in listing)
+        else:
+            names = set(listing)
+        _namesets[dir] = names
+
+    if casefold:
+        leaf = leaf.lower()
+    return leaf in names
+
+def getmtime(path):
+    """
+    The modification time of `path`, or None if it doesn't exist.
+    """
+    global mtimesissued, mtimesserved
+
+    key = _key(path)
+    try:
+        mtime = _mtimes[key]
+        mtimesserved += 1
+        return mtime
+    except KeyError:
+        pass
+
+    if scandirs and not _inlisting(key):
+        _mtimes[key] = None
+        return None
+
+    mtimesissued += 1
+    try:
+        mtime = os.stat(key).st_mtime
+    except OSError:
+        mtime = None
+
+    _mtimes[key] = mtime
+    return mtime
+
+def watch(dir):
+    """
+    Change `watchgeneration` when `dir`, or a path in it, is invalidated.
+    """
+    _watched.add(_key(dir))
+
+def invalidate(path):
+    """
+    Forget what we know about `path`, including its modification time and the listing of the
+    directory containing it.
+    """
+    global watchgeneration, generation
+
+    generation += 1
+    key = _key(path)
+    _stats.pop(key, None)
+    _mtimes.pop(key, None)
+    _listings.pop(key, None)
+    _namesets.pop(key, None)
+    dir = os.path.dirname(key) or '.'
+    _listings.pop(dir, None)
+    _namesets.pop(dir, None)
+
+    if dir in _watched or key in _watched:
+        watchgeneration += 1
+
+def cached():
+    """
+    Get (paths, dirs): the paths whose stat results or modification times are cached, and the
+    directories whose listings are cached.
+    """
+    paths = set(_stats)
+    paths.update(_mtimes)
+    dirs = set(_listings)
+    dirs.update(_namesets)
+    return paths, dirs
+
+def reset():
+    """
+    Forget everything, including modification times, as if the process had just started.
+    """
+    global watchgeneration
+
+    clear()
+    _mtimes.clear()
+    watchgeneration += 1
+
+def clear():
+    """
+    Forget all directory listings and stat results. Modification times are kept: see the
+    module documentation.
+    """
+    global generation
+
+    generation += 1
+    _listings.clear()
+    _namesets.clear()
+    _stats.clear()
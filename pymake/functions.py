@@ -2,8 +2,8 @@
 Makefile functions.
 """
 
-import parser, util
-import subprocess, os, logging
+import parser, util, fscache
+import subprocess, os, logging, re
 from globrelative import glob
 from cStringIO import StringIO
 
@@ -47,13 +47,61 @@ class Function(object):
     def __len__(self):
         return len(self._arguments)
 
+_pycallname = re.compile(r'\s*([^\s,]+)\s+')
+
+def _splitpycall(vname, loc):
+    """
+    If the unresolved variable name `vname` looks like a function call, `name arg1,arg2`, split
+    it into the function name and a list of argument expansions. Arguments are split on literal
+    commas which aren't nested in parentheses or braces, as for built-in functions.
+    Returns None if `vname` isn't a function call.
+    """
+    if vname.simple:
+        elements = [(vname.s, False)]
+    else:
+        elements = list(vname)
+
+    first, isfunc = elements[0]
+    if isfunc:
+        return None
+
+    m = _pycallname.match(first)
+    if m is None:
+        return None
+
+    args = []
+    arg = data.Expansion(loc)
+    depth = 0
+    elements[0] = first[m.end():], False
+    for e, isfunc in elements:
+        if isfunc:
+            arg.appendfunc(e)
+            continue
+
+        start = 0
+        for i, c in enumerate(e):
+            if c in '({':
+                depth += 1
+            elif c in ')}':
+                depth -= 1
+            elif c == ',' and depth == 0:
+                arg.appendstr(e[start:i])
+                args.append(arg.finish())
+                arg = data.Expansion(loc)
+                start = i + 1
+        arg.appendstr(e[start:])
+
+    args.append(arg.finish())
+    return m.group(1), args
+
 class VariableRef(Function):
-    __slots__ = ('vname', 'loc')
+    __slots__ = ('vname', 'loc', '_pycall')
 
     def __init__(self, loc, vname):
         self.loc = loc
         assert isinstance(vname, (data.Expansion, data.StringExpansion))
         self.vname = vname
+        self._pycall = None
         
     def setup(self):
         assert False, "Shouldn't get here"
@@ -65,6 +113,17 @@ class VariableRef(Function):
 
         flavor, source, value = variables.get(vname)
         if value is None:
+            if self._pycall is None:
+                self._pycall = _splitpycall(self.vname, self.loc) or False
+            if self._pycall:
+                fname, args = self._pycall
+                func = makefile.getpythonfunction(fname)
+                if func is not None:
+                    fd.write(callpythonfunction(func, fname,
+                                                [a.resolvestr(makefile, variables, setting) for a in args],
+                                                self.loc))
+                    return
+
             log.debug("%s: variable '%s' was not set" % (self.loc, vname))
             return
 
@@ -391,9 +450,14 @@ class WildcardFunction(Function):
     def resolve(self, makefile, variables, fd, setting):
         patterns = self._arguments[0].resolvesplit(makefile, variables, setting)
 
-        fd.write(' '.join([x.replace('\\','/')
-                           for p in patterns
-                           for x in glob(makefile.workdir, p)]))
+        results = []
+        for p in patterns:
+            found = glob(makefile.workdir, p)
+            if not makefile.parsingfinished:
+                makefile.parsewildcards[p] = found
+            results.extend(found)
+
+        fd.write(' '.join([x.replace('\\','/') for x in results]))
 
     __slots__ = Function.__slots__
 
@@ -606,23 +670,54 @@ class ShellFunction(Function):
     __slots__ = Function.__slots__
 
     def resolve(self, makefile, variables, fd, setting):
-        #TODO: call this once up-front somewhere and save the result?
-        shell, msys = util.checkmsyscompat()
         cline = self._arguments[0].resolvestr(makefile, variables, setting)
 
         log.debug("%s: running shell command '%s'" % (self.loc, cline))
-        if msys:
-            cline = [shell, "-c", cline]
-        p = subprocess.Popen(cline, shell=not msys, stdout=subprocess.PIPE, cwd=makefile.workdir)
-        stdout, stderr = p.communicate()
+        stdout = runshell(makefile, cline)
 
-        stdout = stdout.replace('\r\n', '\n')
-        if stdout.endswith('\n'):
-            stdout = stdout[:-1]
-        stdout = stdout.replace('\n', ' ')
+        if not makefile.parsingfinished:
+            makefile.parseshells.append((cline, stdout))
 
         fd.write(stdout)
 
+def runshell(makefile, cline):
+    """
+    Run the shell command `cline` in the directory of `makefile`, and return its output as
+    $(shell) expands to it.
+    """
+    #TODO: call this once up-front somewhere and save the result?
+    shell, msys = util.checkmsyscompat()
+    if msys:
+        cline = [shell, "-c", cline]
+    p = subprocess.Popen(cline, shell=not msys, stdout=subprocess.PIPE, cwd=makefile.workdir)
+    stdout, stderr = p.communicate()
+
+    # The command may have created or deleted any file
+    fscache.clear()
+
+    stdout = stdout.replace('\r\n', '\n')
+    if stdout.endswith('\n'):
+        stdout = stdout[:-1]
+    return stdout.replace('\n', ' ')
+
+def callpythonfunction(func, fname, args, loc):
+    """
+    Call a Python function registered with .PYMAKE_FUNCTIONS with the resolved arguments, and
+    return its result as a string. Lists and tuples are joined with spaces, and None is empty.
+    """
+    log.debug("%s: calling python function '%s' with arguments %r" % (loc, fname, args))
+    try:
+        r = func(*args)
+        if r is None:
+            return ''
+        if isinstance(r, (list, tuple)):
+            return ' '.join(r)
+        return str(r)
+    except data.DataError:
+        raise
+    except Exception, e:
+        raise data.DataError("Python function '%s' failed: %s" % (fname, e), loc)
+
 class ErrorFunction(Function):
     name = 'error'
     minargs = 1
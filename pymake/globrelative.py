@@ -4,10 +4,11 @@ Filename globbing like the python glob module with minor differences:
 * glob relative to an arbitrary directory
 * include . and ..
 * check that link targets exist, not just links
+* directory listings and existence checks are cached, see fscache
 """
 
-import os, re, fnmatch
-import util
+import os, re
+import util, fscache
 
 _globcheck = re.compile('[[*?]')
 
@@ -32,7 +33,7 @@ def glob(fsdir, path):
 
     for dir in dirsfound:
         fspath = util.normaljoin(fsdir, dir)
-        if not os.path.isdir(fspath):
+        if not fscache.isdir(fspath):
             continue
 
         r.extend((util.normaljoin(dir, found) for found in globpattern(fspath, leaf)))
@@ -46,23 +47,26 @@ def globpattern(dir, pattern):
 
     if not hasglob(pattern):
         if pattern == '':
-            if os.path.isdir(dir):
+            if fscache.isdir(dir):
                 return ['']
             return []
 
-        if os.path.exists(util.normaljoin(dir, pattern)):
+        if fscache.exists(util.normaljoin(dir, pattern)):
             return [pattern]
         return []
 
-    leaves = os.listdir(dir) + ['.', '..']
+    leaves = fscache.listdir(dir)
+    if leaves is None:
+        return []
+    leaves = leaves + ['.', '..']
 
     # "hidden" filenames are a bit special
     if not pattern.startswith('.'):
         leaves = [leaf for leaf in leaves
                   if not leaf.startswith('.')]
 
-    leaves = fnmatch.filter(leaves, pattern)
-    leaves = filter(lambda l: os.path.exists(util.normaljoin(dir, l)), leaves)
+    leaves = fscache.fnmatchfilter(leaves, pattern)
+    leaves = filter(lambda l: fscache.exists(util.normaljoin(dir, l)), leaves)
 
     leaves.sort()
     return leaves
@@ -0,0 +1,166 @@
+"""
+Watching directories for changes with Linux inotify, for --watch.
+"""
+
+import os, struct, select, errno, ctypes, ctypes.util
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+
+IN_CLOEXEC = 0x80000
+
+_CHANGES = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+_event = struct.Struct('iIII')
+
+_libc = None
+
+def _getlibc():
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        _libc = libc
+    return _libc
+
+def _error():
+    e = ctypes.get_errno()
+    return OSError(e, os.strerror(e))
+
+class Inotify(object):
+    """
+    An inotify instance watching directories for files which are written, created, removed,
+    renamed, or touched. Raises OSError if inotify is not available.
+    """
+
+    def __init__(self):
+        self._libc = _getlibc()
+        self.fd = self._libc.inotify_init1(IN_CLOEXEC)
+        if self.fd == -1:
+            raise _error()
+
+        self._dirs = {} # watch descriptor -> directory path
+        self._watched = set()
+
+    def close(self):
+        os.close(self.fd)
+
+    def watch(self, dir):
+        """
+        Watch the directory `dir`, if it exists and isn't watched already. Returns whether it
+        is watched.
+        """
+        if dir in self._watched:
+            return True
+
+        wd = self._libc.inotify_add_watch(self.fd, dir, _CHANGES | IN_ONLYDIR)
+        if wd == -1:
+            e = ctypes.get_errno()
+            if e in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                return False
+            raise _error()
+
+        self._dirs[wd] = dir
+        self._watched.add(dir)
+        return True
+
+    def watching(self, dir):
+        return dir in self._watched
+
+    def read(self, timeout=None):
+        """
+        Wait up to `timeout` seconds, or forever if it is None, for changes, and return the set
+        of paths which changed. The directory path is in the set if events were lost.
+        """
+        r, w, x = select.select([self.fd], [], [], timeout)
+        if not r:
+            return set()
+
+        data = os.read(self.fd, 65536)
+        paths = set()
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, namelen = _event.unpack_from(data, pos)
+            pos += _event.size
+            name = data[pos:pos + namelen].rstrip('\0')
+            pos += namelen
+
+            if mask & IN_Q_OVERFLOW:
+                paths.update(self._watched)
+                continue
+
+            dir = self._dirs.get(wd, None)
+            if dir is None:
+                continue
+
+            if mask & IN_IGNORED:
+                # The directory was removed
+                del self._dirs[wd]
+                self._watched.discard(dir)
+                paths.add(dir)
+                continue
+
+            if name:
+                paths.add(os.path.join(dir, name))
+            else:
+                # An event on the directory itself
+                paths.add(dir)
+
+        return paths
+
+class Watcher(object):
+    """
+    Watch the files a makefile knows about, and collect the ones which change between builds.
+    """
+
+    # Wait this many seconds after a change for other changes, such as the rest of the files
+    # saved by an editor or checkout, before building
+    SETTLE = 0.2
+
+    def __init__(self):
+        self._inotify = Inotify()
+        self._changed = set()
+
+    def watchmakefile(self, makefile):
+        """
+        Watch the directories containing the makefiles and targets of `makefile`.
+        """
+        for path in makefile.watchpaths():
+            self._inotify.watch(os.path.dirname(path))
+
+    def built(self, remade):
+        """
+        A build has finished. Collect the changes made while it ran, except to the paths of the
+        targets it remade, `remade`.
+        """
+        while True:
+            paths = self._inotify.read(0)
+            if not paths:
+                break
+            self._changed.update(paths - remade)
+
+    def wait(self):
+        """
+        Wait for files to change, and return the set of paths which changed.
+        """
+        while not self._changed:
+            self._changed = self._inotify.read()
+
+        while True:
+            paths = self._inotify.read(self.SETTLE)
+            if not paths:
+                break
+            self._changed.update(paths)
+
+        changed = self._changed
+        self._changed = set()
+        return changed
@@ -765,7 +765,7 @@ def parsemakesyntax(d, offset, stopon, iterfunc):
             di = iterfunc(d, offset, stacktop.tokenlist, tokeniterator)
 
     if stacktop.parent is not None:
-        raise SyntaxError("Unterminated function call", d.getloc(offset))
+        raise SyntaxError("Unterminated function call", d.getloc(d.lend))
 
     assert stacktop.parsestate == _PARSESTATE_TOPLEVEL
 
@@ -21,6 +21,11 @@ class Location(object):
         self.line = line
         self.column = column
 
+    def __reduce__(self):
+        # Pickling by the generic __slots__ support is slow, and makefile snapshots hold a
+        # great many locations
+        return Location, (self.path, self.line, self.column)
+
     def offset(self, s, start, end):
         """
         Returns a new location offset by
@@ -62,6 +67,8 @@ def _expandwildcards(makefile, tlist):
             yield t
         else:
             l = glob(makefile.workdir, t)
+            if not makefile.parsingfinished:
+                makefile.parsewildcards[t] = l
             for r in l:
                 yield r
 
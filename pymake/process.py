@@ -5,10 +5,12 @@ parsing command lines into argv and making sure that no shell magic is being use
 
 #TODO: ship pyprocessing?
 import multiprocessing, multiprocessing.dummy
-import subprocess, shlex, re, logging, sys, traceback, os, imp, glob
+import subprocess, shlex, re, logging, sys, traceback, os, imp, heapq
+from collections import deque
 # XXXkhuey Work around http://bugs.python.org/issue1731717
 subprocess._cleanup = lambda: None
 import command, util
+from globrelative import glob
 if sys.platform=='win32':
     import win32process
 
@@ -37,12 +39,14 @@ def clinetoargv(cline):
 
 def doglobbing(args, cwd):
     """
-    Perform any needed globbing on the argument list passed in
+    Perform any needed globbing on the argument list passed in. Like the shell, '.' and '..'
+    are never matched.
     """
     globbedargs = []
     for arg in args:
         if _needsglob.search(arg):
-            globbedargs.extend(glob.glob(os.path.join(cwd, arg)))
+            globbedargs.extend((os.path.join(cwd, found) for found in glob(cwd, arg)
+                                if os.path.basename(found) not in ('.', '..')))
         else:
             globbedargs.append(arg)
 
@@ -56,7 +60,20 @@ shellwords = (':', '.', 'break', 'cd', 'continue', 'exec', 'exit', 'export',
               'printf', 'read', 'shopt', 'source', 'type', 'typeset',
               'ulimit', 'unalias', 'set')
 
-def call(cline, env, cwd, loc, cb, context, echo, justprint=False):
+def _justprint(echo, cb):
+    """
+    Print a command instead of running it. This doesn't go through the parallel context, so
+    commands are printed as soon as they are reached.
+    """
+    if echo is not None:
+        print echo
+    cb(res=0)
+
+def call(cline, env, cwd, loc, cb, context, echo, justprint=False, priority=0, startcb=None):
+    """
+    Run a command line. `startcb`, if given, is called when the command actually starts,
+    after waiting for a free job slot.
+    """
     #TODO: call this once up-front somewhere and save the result?
     shell, msys = util.checkmsyscompat()
 
@@ -74,12 +91,15 @@ def call(cline, env, cwd, loc, cb, context, echo, justprint=False):
 
     if shellreason is not None:
         _log.debug("%s: using shell: %s: '%s'", loc, shellreason, cline)
+        if justprint:
+            _justprint(echo, cb)
+            return
         if msys:
             if len(cline) > 3 and cline[1] == ':' and cline[2] == '/':
                 cline = '/' + cline[0] + cline[2:]
             cline = [shell, "-c", cline]
         context.call(cline, shell=not msys, env=env, cwd=cwd, cb=cb, echo=echo,
-                     justprint=justprint)
+                     justprint=justprint, priority=priority, startcb=startcb)
         return
 
     if not len(argv):
@@ -87,27 +107,40 @@ def call(cline, env, cwd, loc, cb, context, echo, justprint=False):
         return
 
     if argv[0] == command.makepypath:
+        if startcb is not None:
+            startcb()
         command.main(argv[1:], env, cwd, cb)
         return
 
     if argv[0:2] == [sys.executable.replace('\\', '/'),
                      command.makepypath.replace('\\', '/')]:
+        if startcb is not None:
+            startcb()
         command.main(argv[2:], env, cwd, cb)
         return
 
+    if justprint:
+        _justprint(echo, cb)
+        return
+
     if argv[0].find('/') != -1:
         executable = util.normaljoin(cwd, argv[0])
     else:
         executable = None
 
     context.call(argv, executable=executable, shell=False, env=env, cwd=cwd, cb=cb,
-                 echo=echo, justprint=justprint)
+                 echo=echo, justprint=justprint, priority=priority, startcb=startcb)
 
 def call_native(module, method, argv, env, cwd, loc, cb, context, echo, justprint=False,
-                pycommandpath=None):
+                pycommandpath=None, priority=0, startcb=None):
+    if justprint:
+        _justprint(echo, cb)
+        return
+
     argv = doglobbing(argv, cwd)
     context.call_native(module, method, argv, env=env, cwd=cwd, cb=cb,
-                        echo=echo, justprint=justprint, pycommandpath=pycommandpath)
+                        echo=echo, justprint=justprint, pycommandpath=pycommandpath,
+                        priority=priority, startcb=startcb)
 
 def statustoresult(status):
     """
@@ -199,7 +232,8 @@ class PythonJob(Job):
         oldenv = os.environ
         try:
             os.chdir(self.cwd)
-            os.environ = self.env
+            # self.env may be shared with other commands
+            os.environ = dict(self.env)
             if self.module not in sys.modules:
                 load_module_recursive(self.module,
                                       sys.path + self.pycommandpath)
@@ -231,6 +265,10 @@ def job_runner(job):
 class ParallelContext(object):
     """
     Manages the parallel execution of processes.
+
+    Deferred callbacks run in the order they were deferred. When more than one job may run at a
+    time, jobs wait in a separate queue and the waiting job with the highest priority is started
+    whenever a job slot is free. Jobs with equal priority start in the order they were queued.
     """
 
     _allcontexts = set()
@@ -242,13 +280,15 @@ class ParallelContext(object):
 
         self.processpool = multiprocessing.Pool(processes=jcount)
         self.threadpool = multiprocessing.dummy.Pool(processes=jcount)
-        self.pending = [] # list of (cb, args, kwargs)
+        self.pending = deque() # of (cb, args, kwargs)
         self.running = [] # list of (subprocess, cb)
+        self.jobs = [] # heap of (-priority, sequence, cb, args)
+        self._jobsequence = 0
 
         self._allcontexts.add(self)
 
     def finish(self):
-        assert len(self.pending) == 0 and len(self.running) == 0, "pending: %i running: %i" % (len(self.pending), len(self.running))
+        assert len(self.pending) == 0 and len(self.running) == 0 and len(self.jobs) == 0, "pending: %i running: %i jobs: %i" % (len(self.pending), len(self.running), len(self.jobs))
         self.processpool.close()
         self.threadpool.close()
         self.processpool.join()
@@ -256,15 +296,39 @@ class ParallelContext(object):
         self._allcontexts.remove(self)
 
     def run(self):
-        while len(self.pending) and len(self.running) < self.jcount:
-            cb, args, kwargs = self.pending.pop(0)
-            cb(*args, **kwargs)
+        if self.jcount == 1:
+            while len(self.pending) and len(self.running) < self.jcount:
+                cb, args, kwargs = self.pending.popleft()
+                cb(*args, **kwargs)
+            return
+
+        # Run deferred callbacks first: they may queue more jobs, which then compete for the
+        # free job slots by priority.
+        while True:
+            if len(self.pending):
+                cb, args, kwargs = self.pending.popleft()
+                cb(*args, **kwargs)
+            elif len(self.jobs) and len(self.running) < self.jcount:
+                p, seq, cb, args = heapq.heappop(self.jobs)
+                cb(*args)
+            else:
+                return
 
     def defer(self, cb, *args, **kwargs):
         assert self.jcount > 1 or not len(self.pending), "Serial execution error defering %r %r %r: currently pending %r" % (cb, args, kwargs, self.pending)
         self.pending.append((cb, args, kwargs))
 
-    def _docall_generic(self, pool, job, cb, echo, justprint):
+    def _deferjob(self, priority, cb, *args):
+        if self.jcount == 1:
+            self.defer(cb, *args)
+            return
+
+        heapq.heappush(self.jobs, (-priority, self._jobsequence, cb, args))
+        self._jobsequence += 1
+
+    def _docall_generic(self, pool, job, cb, echo, justprint, startcb):
+        if startcb is not None:
+            startcb()
         if echo is not None:
             print echo
         processcb = job.get_callback(ParallelContext._condition)
@@ -274,22 +338,23 @@ class ParallelContext(object):
             pool.apply_async(job_runner, args=(job,), callback=processcb)
         self.running.append((job, cb))
 
-    def call(self, argv, shell, env, cwd, cb, echo, justprint=False, executable=None):
+    def call(self, argv, shell, env, cwd, cb, echo, justprint=False, executable=None,
+             priority=0, startcb=None):
         """
         Asynchronously call the process
         """
 
         job = PopenJob(argv, executable=executable, shell=shell, env=env, cwd=cwd)
-        self.defer(self._docall_generic, self.threadpool, job, cb, echo, justprint)
+        self._deferjob(priority, self._docall_generic, self.threadpool, job, cb, echo, justprint, startcb)
 
     def call_native(self, module, method, argv, env, cwd, cb,
-                    echo, justprint=False, pycommandpath=None):
+                    echo, justprint=False, pycommandpath=None, priority=0, startcb=None):
         """
         Asynchronously call the native function
         """
 
         job = PythonJob(module, method, argv, env, cwd, pycommandpath)
-        self.defer(self._docall_generic, self.processpool, job, cb, echo, justprint)
+        self._deferjob(priority, self._docall_generic, self.processpool, job, cb, echo, justprint, startcb)
 
     @staticmethod
     def _waitany(condition):
@@ -319,6 +384,19 @@ class ParallelContext(object):
 
         return jobs
         
+    @staticmethod
+    def abandon():
+        """
+        Drop all pending callbacks and queued jobs, and wait for running jobs to finish without
+        notifying anyone, so that the contexts can be used for an unrelated build.
+        """
+        for c in ParallelContext._allcontexts:
+            c.pending.clear()
+            c.jobs = []
+
+        while util.any((len(c.running) for c in ParallelContext._allcontexts)):
+            ParallelContext._waitany(ParallelContext._condition)
+
     @staticmethod
     def spin():
         """
@@ -336,7 +414,7 @@ class ParallelContext(object):
                 for job, cb in ParallelContext._waitany(ParallelContext._condition):
                     cb(job.exitcode)
             else:
-                assert any(len(c.pending) for c in ParallelContext._allcontexts)
+                assert any(len(c.pending) or len(c.jobs) for c in ParallelContext._allcontexts)
 
 def makedeferrable(usercb, **userkwargs):
     def cb(*args, **kwargs):
@@ -347,14 +425,29 @@ def makedeferrable(usercb, **userkwargs):
 
 _serialContext = None
 _parallelContext = None
+_newbuild = False
+
+def startbuild():
+    """
+    Start a make unrelated to the ones before it, as the build server does for each request.
+    The next parallel context asked for has the number of jobs it asks for, instead of sharing
+    the one kept from an earlier make.
+    """
+    global _newbuild
+    _newbuild = True
 
 def getcontext(jcount):
-    global _serialContext, _parallelContext
+    global _serialContext, _parallelContext, _newbuild
     if jcount == 1:
         if _serialContext is None:
             _serialContext = ParallelContext(1)
         return _serialContext
     else:
+        if _newbuild and _parallelContext is not None and _parallelContext.jcount != jcount:
+            _parallelContext.finish()
+            _parallelContext = None
+        _newbuild = False
+
         if _parallelContext is None:
             _parallelContext = ParallelContext(jcount)
         return _parallelContext
@@ -0,0 +1,126 @@
+"""
+Snapshots of parsed makefiles, so that makes whose makefiles haven't changed can skip parsing.
+
+A snapshot file holds a pickle of the data.Makefile as it was when parsing finished, before any
+makefiles were remade, along with what it was parsed from:
+
+* a hash of the command line, environment and working directory of the make
+* the modification time and size of each makefile, and of pymake's own modules
+
+A make with the same command line, environment and working directory loads the makefile from
+the snapshot instead of parsing, if none of the files have changed and
+Makefile.parseinputschanged() says that the $(shell) and $(wildcard) results used while parsing
+are still the same.
+"""
+
+import os, cPickle, hashlib, logging
+
+_log = logging.getLogger('pymake.snapshot')
+
+# Change this when the format of the file changes
+SNAPSHOTVERSION = 1
+
+def stamp(path):
+    """
+    The modification time and size of `path`, or None if it doesn't exist.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime, st.st_size
+
+def makefilestamps(makefile):
+    """
+    Get {path: stamp} for each of the files `makefile` was parsed from.
+    """
+    stamps = {}
+    for path, required in makefile.included:
+        fspath = os.path.join(makefile.workdir, path)
+        stamps[fspath] = stamp(fspath)
+    return stamps
+
+def changedstamp(stamps):
+    """
+    Return a path from `stamps` which has changed, or None.
+    """
+    for path, s in stamps.iteritems():
+        if stamp(path) != s:
+            return path
+    return None
+
+_modulestamps = None
+
+def _getmodulestamps():
+    global _modulestamps
+    if _modulestamps is None:
+        dir = os.path.dirname(os.path.abspath(__file__))
+        _modulestamps = dict((os.path.join(dir, leaf), stamp(os.path.join(dir, leaf)))
+                             for leaf in os.listdir(dir) if leaf.endswith('.py'))
+    return _modulestamps
+
+def _keyhash(key):
+    return hashlib.sha1(repr(key)).hexdigest()
+
+def save(path, key, makefile):
+    """
+    Save a snapshot of `makefile`, which has just finished parsing, to `path`. `key` is the
+    command line, environment and working directory of the make, as a tuple.
+    """
+    stamps = makefilestamps(makefile)
+    stamps.update(_getmodulestamps())
+
+    tmppath = '%s.tmp%i' % (path, os.getpid())
+    try:
+        fd = open(tmppath, 'wb')
+        try:
+            cPickle.dump((SNAPSHOTVERSION, _keyhash(key), stamps), fd, cPickle.HIGHEST_PROTOCOL)
+            cPickle.dump(makefile, fd, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            fd.close()
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmppath, path)
+    except (IOError, OSError, cPickle.PicklingError, TypeError), e:
+        _log.warning("Couldn't save makefile snapshot '%s': %s", path, e)
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+
+def load(path, key):
+    """
+    Load the makefile from the snapshot at `path`, if there is one for `key` which is still
+    valid. Returns None otherwise. The makefile must be attached to a make with
+    Makefile.attach before it is used.
+    """
+    try:
+        fd = open(path, 'rb')
+    except IOError:
+        return None
+
+    try:
+        try:
+            version, keyhash, stamps = cPickle.load(fd)
+            if version != SNAPSHOTVERSION:
+                _log.info("Not using makefile snapshot '%s': it has a different version", path)
+                return None
+            if keyhash != _keyhash(key):
+                _log.info("Not using makefile snapshot '%s': the command line, environment or directory is different", path)
+                return None
+
+            changed = changedstamp(stamps)
+            if changed is not None:
+                _log.info("Not using makefile snapshot '%s': %s changed", path, changed)
+                return None
+
+            makefile = cPickle.load(fd)
+        finally:
+            fd.close()
+    except Exception, e:
+        _log.warning("Couldn't load makefile snapshot '%s': %s", path, e)
+        return None
+
+    if makefile.parseinputschanged():
+        _log.info("Not using makefile snapshot '%s': $(shell) or $(wildcard) results changed", path)
+        return None
+
+    return makefile
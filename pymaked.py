@@ -0,0 +1,18 @@
+#!/usr/bin/env python
+
+"""
+pymaked.py SOCKET
+
+Run a pymake build server listening on the Unix socket SOCKET. make.py hands makes to the
+server when PYMAKE_DAEMON=SOCKET is set in its environment.
+"""
+
+import sys
+import pymake.daemon
+
+if __name__ == '__main__':
+  if len(sys.argv) != 2:
+    print >>sys.stderr, __doc__.strip()
+    sys.exit(2)
+
+  pymake.daemon.serve(sys.argv[1])
@@ -0,0 +1,40 @@
+#T gmake skip
+#T commandline: ['--command-signatures', '--state-db=signatures.db']
+
+# With --command-signatures, a target is remade when its expanded commands change.
+
+FLAGS = -a
+
+all:
+	$(MAKE) -f $(TESTPATH)/command-signatures.mk out
+	$(MAKE) -f $(TESTPATH)/command-signatures.mk out
+	$(MAKE) -f $(TESTPATH)/command-signatures.mk out FLAGS=-b
+	test "`cat out`" = "-b"
+	test `wc -l < log` -eq 2
+	echo in > sig.in
+	$(MAKE) -f $(TESTPATH)/command-signatures.mk sig.out
+	$(MAKE) -f $(TESTPATH)/command-signatures.mk sig.out
+	test "`cat sig.out`" = "sig.in"
+	test `wc -l < siglog` -eq 1
+	mkdir vdir
+	touch vdir/sig.v
+	$(MAKE) -f $(TESTPATH)/command-signatures.mk sig.v
+	$(MAKE) -f $(TESTPATH)/command-signatures.mk sig.v
+	test ! -f sig.v
+	$(MAKE) -f $(TESTPATH)/command-signatures.mk sig.v FLAGS=-b
+	test "`cat sig.v`" = "-b in"
+	@echo TEST-PASS
+
+out:
+	echo $(FLAGS) > $@
+	echo built >> log
+
+# $? is the same whether or not sig.in is newer, so the second make doesn't remake sig.out
+sig.out: sig.in
+	echo $? > $@
+	echo built >> siglog
+
+# Found in vdir by vpath, so $@ differs from the path of the target until it is remade
+vpath %.v vdir
+sig.v: sig.in
+	echo $(FLAGS) `cat $<` > $@
@@ -0,0 +1,21 @@
+#T gmake skip
+
+# --slowest only reports targets remade by this make, not up-to-date prerequisites whose
+# contents were hashed.
+
+HASHMAKE = $(MAKE) -f $(TESTPATH)/content-hash-slowest.mk --content-hash --state-db=hash.db
+
+all:
+	$(HASHMAKE) out
+	touch -t 200001010000 out
+	touch gen.in
+	$(HASHMAKE) --slowest=5 out > slowest.log
+	grep -q 'slowest targets' slowest.log && \
+	! grep -q 'gen.in' slowest.log && \
+	echo TEST-PASS
+
+gen.in:
+	echo one > $@
+
+out: gen.in
+	cat gen.in > $@
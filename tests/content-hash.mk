@@ -0,0 +1,33 @@
+#T gmake skip
+#T commandline: ['--content-hash', '--state-db=hash.db']
+
+# With --content-hash, a target whose prerequisites are newer is only remade if their
+# contents changed since it was last remade.
+
+CONTENT = one
+
+all:
+	$(MAKE) -f $(TESTPATH)/content-hash.mk out
+	touch -t 200001010000 out
+	$(MAKE) -f $(TESTPATH)/content-hash.mk out
+	$(MAKE) -f $(TESTPATH)/content-hash.mk out CONTENT=two
+	test "`cat out`" = "two"
+	test `wc -l < log` -eq 2
+	mkdir subdir
+	$(MAKE) -f $(TESTPATH)/content-hash.mk dirout
+	test -f dirout
+	@echo TEST-PASS
+
+# A generator which rewrites its output every time
+gen.h: FORCE
+	echo $(CONTENT) > $@
+
+FORCE:
+
+out: gen.h
+	cat gen.h > $@
+	echo built >> log
+
+# Directories have no contents to hash
+dirout: subdir
+	touch $@
@@ -0,0 +1,38 @@
+#T gmake skip
+
+# make.py hands makes to the build server named by PYMAKE_DAEMON. The server reuses the
+# makefiles it parsed for an earlier make with the same command line, and sends back the
+# output and exit code of each make. Files which change between makes are noticed, and
+# options such as -d only apply to the make which used them.
+
+DAEMONMAKE = PYMAKE_DAEMON=$(CURDIR)/daemon.sock $(MAKE) -f $(TESTPATH)/daemon.mk
+
+all:
+	rm -f daemon.sock; \
+	$(firstword $(MAKE)) $(TESTPATH)/../pymaked.py daemon.sock > daemon.log 2>&1 & \
+	pid=$$!; trap "kill $$pid" EXIT; \
+	for i in 1 2 3 4 5 6 7 8 9 10; do test -S daemon.sock && break; sleep 0.5; done; \
+	$(DAEMONMAKE) -d served > first.log 2>&1 && \
+	$(DAEMONMAKE) -d served > second.log 2>&1 && \
+	{ $(DAEMONMAKE) failed > third.log 2>&1; test $$? = 2; } && \
+	$(DAEMONMAKE) served > fourth.log 2>&1 && \
+	touch input && $(DAEMONMAKE) output && \
+	touch -t 203001010000 input && $(DAEMONMAKE) output && \
+	grep -q 'made served' first.log && \
+	grep -q 'made served' second.log && \
+	! grep -q 'Reusing makefiles' first.log && \
+	grep -q 'Reusing makefiles' second.log && \
+	grep -q 'exit 3' third.log && \
+	grep -q 'modification times read' first.log && \
+	! grep -q 'modification times read' fourth.log && \
+	test `wc -l < output` -eq 2 && \
+	echo TEST-PASS
+
+served:
+	@echo made served
+
+failed:
+	exit 3
+
+output: input
+	echo built >> $@
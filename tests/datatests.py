@@ -1,6 +1,7 @@
-import pymake.data, pymake.util
+import pymake.data, pymake.parser, pymake.util, pymake.fscache, pymake.buildcache, pymake.snapshot
+import pymake.process, pymake.builddb, pymake.inotify
 import unittest
-import re
+import re, os, tempfile, shutil
 from cStringIO import StringIO
 
 def multitest(cls):
@@ -41,6 +42,478 @@ class GetPatSubstTest(unittest.TestCase):
                           for word in words))
             self.assertEqual(a, e, 'Pattern(%r).subst(%r, %r)' % (s, r, d))
 
+class PatternIndexTest(unittest.TestCase):
+    patterns = ('%.c', 'lib%.c', '%', 'foo.c', '%.o', 'sub/%.c', 'x%')
+
+    def runTest(self):
+        index = pymake.data.PatternIndex()
+        for i, p in enumerate(self.patterns):
+            index.add(pymake.data.Pattern(p), i)
+
+        for word in ('libfoo.c', 'foo.c', 'sub/a.c', 'a.o', 'x', 'c'):
+            expected = [i for i, p in enumerate(self.patterns)
+                        if pymake.data.Pattern(p).match(word) is not None]
+            found = [value for seq, p, value in index.candidates(word)
+                     if p.match(word) is not None]
+            self.assertEqual(found, expected, 'candidates(%r)' % (word,))
+
+        self.assertEqual([value for seq, p, value in index.candidates('a.h')], [2, 6])
+
+class EnvironmentVariablesTest(unittest.TestCase):
+    def runTest(self):
+        env = {'A': 'aval', 'B': 'bval', 'C': 'cval'}
+        v = pymake.data.Variables()
+        v.readfromenvironment(env)
+
+        self.assertEqual(v._map, {})
+        self.assertTrue('A' in v)
+        self.assertFalse('D' in v)
+        self.assertEqual(v.get('A', expand=False),
+                         (v.FLAVOR_SIMPLE, v.SOURCE_ENVIRONMENT, 'aval'))
+        self.assertEqual(v._map.keys(), ['A'])
+
+        v.set('B', v.FLAVOR_RECURSIVE, v.SOURCE_MAKEFILE, 'makeval')
+        v.append('C', v.SOURCE_MAKEFILE, 'more', v, None)
+        self.assertEqual(v.get('C', expand=False)[2], 'cval more')
+
+        self.assertEqual(sorted((k, source, value) for k, flavor, source, value in v),
+                         [('A', v.SOURCE_ENVIRONMENT, 'aval'),
+                          ('B', v.SOURCE_MAKEFILE, 'makeval'),
+                          ('C', v.SOURCE_ENVIRONMENT, 'cval more')])
+        self.assertEqual(env, {'A': 'aval', 'B': 'bval', 'C': 'cval'})
+
+class InternTest(unittest.TestCase):
+    def runTest(self):
+        m = pymake.data.Makefile()
+        stmts = pymake.parser.parsestring('a.o: x.h y.h\nb.o: x.h\n%.o: %.c z.h\n', 'InternTest')
+        stmts.execute(m)
+        m.finishparsing()
+
+        x = m.gettarget('x.h')
+        a, = m.gettarget('a.o').rules
+        b, = m.gettarget('b.o').rules
+        self.assertTrue(a.prerequisites[0] is x.target)
+        self.assertTrue(b.prerequisites[0] is x.target)
+
+        irule, = m.implicitrules
+        instance = pymake.data.PatternRuleInstance(irule, '', 'c', False)
+        self.assertTrue(instance.prerequisites[1] is
+                        pymake.data.PatternRuleInstance(irule, '', 'd', False).prerequisites[1])
+
+class DependencyGraphTest(unittest.TestCase):
+    def runTest(self):
+        m = pymake.data.Makefile()
+        stmts = pymake.parser.parsestring('.PHONY: all\nall: a.o b.o\na.o: a.c x.h\nb.o:: x.h\n'
+                                          'extra: d.in\n%.c: %.in\n\tcp $< $@\n', 'DependencyGraphTest')
+        stmts.execute(m)
+        m.finishparsing()
+
+        g = m.graph
+        G = pymake.data.DependencyGraph
+        def id(name):
+            return m.gettarget(name).nodeid
+
+        self.assertEqual(g.prerequisites[id('all')], [id('a.o'), id('b.o')])
+        self.assertEqual(sorted(g.dependents[id('x.h')]), sorted([id('a.o'), id('b.o')]))
+        self.assertEqual(g.flags[id('all')], G.FLAG_EXPLICIT | G.FLAG_PHONY)
+        self.assertEqual(g.flags[id('b.o')], G.FLAG_EXPLICIT | G.FLAG_DOUBLECOLON)
+        self.assertEqual(g.flags[id('x.h')], G.FLAG_EXPLICIT)
+        self.assertEqual([t.target for t in g.ruletargets(m.gettarget('a.o').rules[0])], ['a.c', 'x.h'])
+
+        # Implicit rules extend the graph with new nodes and edges
+        nodes = len(g.nodes)
+        t = m.gettarget('d.c')
+        self.assertEqual(t.nodeid, nodes)
+        self.assertEqual(g.flags[t.nodeid], 0)
+        t.resolveimplicitrule(m, [], [])
+        self.assertEqual(g.prerequisites[t.nodeid], [id('d.in')])
+        self.assertEqual(g.dependents[id('d.in')], [id('extra'), t.nodeid])
+
+class ImplicitMemoTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def runTest(self):
+        for name in ('a.c', 'b.c'):
+            open(os.path.join(self.dir, name), 'w').close()
+
+        m = pymake.data.Makefile(workdir=self.dir)
+        stmts = pymake.parser.parsestring('%.o: %.c gen.h\n\tcc\n%.h: %.in\n\tgen\n', 'ImplicitMemoTest')
+        stmts.execute(m)
+        m.finishparsing()
+
+        # gen.h can't be made, so neither object can; the failed probe for gen.h is only
+        # searched once
+        a = m.gettarget('a.o')
+        a.resolveimplicitrule(m, [], [])
+        self.assertEqual(a.rules, [])
+        hits = m.implicitmemohits
+
+        b = m.gettarget('b.o')
+        b.resolveimplicitrule(m, [], [])
+        self.assertEqual(b.rules, [])
+        self.assertEqual(m.implicitmemohits, hits + 1)
+
+        self.assertNotEqual(len(m.getimplicitmemo()), 0)
+        pymake.fscache.clear()
+        self.assertEqual(len(m.getimplicitmemo()), 0)
+
+class FreezeTest(unittest.TestCase):
+    def runTest(self):
+        m = pymake.data.Makefile()
+        stmts = pymake.parser.parsestring('.PHONY: all clean\n.NOTPARALLEL:\n.SUFFIXES:\n'
+                                          '.PHONY: check\nall: sub/a.o\n', 'FreezeTest')
+        stmts.execute(m)
+        m.finishparsing()
+
+        self.assertEqual(m.phonytargets, frozenset(('all', 'clean', 'check')))
+        self.assertEqual(m.specialtargets, frozenset(('.PHONY', '.NOTPARALLEL', '.SUFFIXES')))
+        self.assertTrue(m.gettarget('check').isphony(m))
+        self.assertFalse(m.gettarget('sub/a.o').isphony(m))
+        self.assertTrue(m.gettarget('sub/a.o/') is m.gettarget('sub/a.o'))
+        self.assertRaises(pymake.data.DataError, m.gettarget, 'sub/*.o')
+
+class SubEnvironmentTest(unittest.TestCase):
+    def runTest(self):
+        m = pymake.data.Makefile(env={})
+        stmts = pymake.parser.parsestring('export FOO = global\n', 'SubEnvironmentTest')
+        stmts.execute(m)
+
+        v = pymake.data.Variables(parent=m.variables)
+        v.set('FOO', pymake.data.Variables.FLAVOR_SIMPLE, pymake.data.Variables.SOURCE_MAKEFILE, 'target')
+
+        # Before parsing finishes as well as after, the values in a scope are exported
+        self.assertEqual(m.getsubenvironment(v)['FOO'], 'target')
+        self.assertEqual(m.getsubenvironment(m.variables)['FOO'], 'global')
+        m.finishparsing()
+        self.assertEqual(m.getsubenvironment(v)['FOO'], 'target')
+        self.assertEqual(m.getsubenvironment(m.variables)['FOO'], 'global')
+
+class ResetBuildStateTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def runTest(self):
+        open(os.path.join(self.dir, 'a.c'), 'w').close()
+
+        m = pymake.data.Makefile(workdir=self.dir)
+        stmts = pymake.parser.parsestring('all: a.o\n%.o: %.c\n\tcc\n', 'ResetBuildStateTest')
+        stmts.execute(m)
+        m.finishparsing()
+
+        t = m.gettarget('a.o')
+        t.resolvedeps(m, [], [], True)
+        self.assertEqual(len(t.rules), 1)
+        self.assertEqual(t.vpathtarget, 'a.o')
+        c = m.gettarget('a.c')
+        self.assertEqual(m.graph.dependents[c.nodeid], [t.nodeid])
+
+        m.resetbuildstate()
+        self.assertEqual(t.rules, [])
+        self.assertEqual(t.vpathtarget, None)
+        self.assertEqual(m.graph.prerequisites[t.nodeid], [])
+        self.assertEqual(m.graph.dependents[c.nodeid], [])
+
+        t.resolvedeps(m, [], [], True)
+        self.assertEqual(len(t.rules), 1)
+
+class ResetChangedTest(unittest.TestCase):
+    def runTest(self):
+        m = pymake.data.Makefile(workdir='/w')
+        stmts = pymake.parser.parsestring('all: prog other\nprog: a.o b.o\nother: other.in\n', 'ResetChangedTest')
+        stmts.execute(m)
+        m.finishparsing()
+
+        for t in m.graph.nodes:
+            t._state = pymake.data.MAKESTATE_FINISHED
+            t.error = False
+
+        reset = m.resetchanged(set(['/w/a.o']))
+        self.assertEqual(sorted(t.target for t in reset), ['a.o', 'all', 'prog'])
+        self.assertEqual(m.gettarget('b.o')._state, pymake.data.MAKESTATE_FINISHED)
+        self.assertEqual(m.gettarget('other')._state, pymake.data.MAKESTATE_FINISHED)
+
+        for t in reset:
+            t._state = pymake.data.MAKESTATE_FINISHED
+        m.gettarget('other').error = True
+        reset = m.resetchanged(set(['/elsewhere/b.o']))
+        self.assertEqual(sorted(t.target for t in reset), ['all', 'other'])
+
+        self.assertTrue('/w/other.in' in set(m.watchpaths()))
+
+class ImplicitMemoRecursionTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def runTest(self):
+        open(os.path.join(self.dir, 'a.y'), 'w').close()
+
+        m = pymake.data.Makefile(workdir=self.dir, env={})
+        stmts = pymake.parser.parsestring('%.o: %.c\n\tcc\n%.c: %.y\n\tyacc\n', 'ImplicitMemoRecursionTest')
+        stmts.execute(m)
+        m.finishparsing()
+
+        # The chain through a.c can't be used while a.c is being resolved...
+        t = m.gettarget('a.o')
+        t.resolveimplicitrule(m, ['a.c', 'a.o'], [])
+        self.assertEqual(t.rules, [])
+
+        # ...but that isn't remembered for other searches
+        t.resolveimplicitrule(m, ['a.o'], [])
+        self.assertEqual(len(t.rules), 1)
+
+class ParallelErrorTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def runTest(self):
+        m = pymake.data.Makefile(workdir=self.dir, env={}, context=pymake.process.getcontext(2))
+        stmts = pymake.parser.parsestring('all: a\na:\n', 'ParallelErrorTest')
+        stmts.execute(m)
+        m.finishparsing()
+
+        t = m.gettarget('all')
+        t.resolvedeps(m, [], [], False)
+        r = pymake.data.RemakeRuleContext(t, m, t.rules[0], [(m.gettarget('a'), False)], [], False)
+
+        # Prerequisites started after the make has failed fail without being made
+        results = []
+        m.error = True
+        r.resolvedeps(False, lambda error, didanything: results.append(error))
+        m.context.run()
+        self.assertEqual(results, [True])
+        self.assertEqual(m.gettarget('a')._state, pymake.data.MAKESTATE_NONE)
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.snapshot = os.path.join(self.dir, 'snapshot')
+        self.key = (('-f', 'Makefile'), (), self.dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, s):
+        fd = open(os.path.join(self.dir, name), 'w')
+        fd.write(s)
+        fd.close()
+
+    def parse(self):
+        m = pymake.data.Makefile(workdir=self.dir, env={})
+        m.include('Makefile')
+        m.finishparsing()
+        return m
+
+    def runTest(self):
+        self.write('Makefile', 'SRCS := $(wildcard *.c)\nHOST := $(shell cat host)\nall: $(SRCS:.c=.o)\n%.o: %.c\n\tcc $<\n')
+        self.write('a.c', '')
+        self.write('host', 'h1')
+
+        pymake.snapshot.save(self.snapshot, self.key, self.parse())
+
+        m = pymake.snapshot.load(self.snapshot, self.key)
+        self.assertNotEqual(m, None)
+        self.assertEqual(m.variables.get('HOST')[2].resolvestr(m, m.variables), 'h1')
+        self.assertEqual([r.prerequisites for r in m.gettarget('all').rules], [['a.o']])
+        self.assertEqual(len(m.implicitrules), 1)
+
+        self.assertEqual(pymake.snapshot.load(self.snapshot, self.key + ('other',)), None)
+
+        self.write('b.c', '')
+        self.assertEqual(pymake.snapshot.load(self.snapshot, self.key), None)
+        pymake.snapshot.save(self.snapshot, self.key, self.parse())
+        self.assertNotEqual(pymake.snapshot.load(self.snapshot, self.key), None)
+
+        self.write('host', 'h2')
+        self.assertEqual(pymake.snapshot.load(self.snapshot, self.key), None)
+        pymake.snapshot.save(self.snapshot, self.key, self.parse())
+        self.assertNotEqual(pymake.snapshot.load(self.snapshot, self.key), None)
+
+        # a different size, in case the modification time doesn't change
+        self.write('Makefile', 'all:\n')
+        self.assertEqual(pymake.snapshot.load(self.snapshot, self.key), None)
+
+class SnapshotEnvironmentTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.snapshot = os.path.join(self.dir, 'snapshot')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def runTest(self):
+        fd = open(os.path.join(self.dir, 'Makefile'), 'w')
+        fd.write('ifeq ($(TOKEN),s3cret-token)\nFOUND = 1\nendif\nFLAGS += -O2\nexport TOKEN\n'
+                 'all: FLAGS += -g\n%.o: FLAGS += -c\nall:\n')
+        fd.close()
+
+        env = {'TOKEN': 's3cret-token', 'FLAGS': 's3cret-flags'}
+        key = (('all',), tuple(sorted(env.iteritems())), self.dir)
+        m = pymake.data.Makefile(workdir=self.dir, env=env)
+        m.include('Makefile')
+        m.finishparsing()
+        pymake.snapshot.save(self.snapshot, key, m)
+
+        # Values from the environment aren't written to the snapshot
+        data = open(self.snapshot, 'rb').read()
+        self.assertFalse('s3cret' in data)
+
+        m = pymake.snapshot.load(self.snapshot, key)
+        m.attach(env, None, None, None)
+        self.assertEqual(m.variables.get('FOUND')[2].resolvestr(m, m.variables), '1')
+        self.assertEqual(m.variables.get('TOKEN')[1], pymake.data.Variables.SOURCE_ENVIRONMENT)
+        self.assertEqual(m.variables.get('FLAGS')[2].resolvestr(m, m.variables), 's3cret-flags -O2')
+        self.assertEqual(m.gettarget('all').variables.get('FLAGS', False)[2], 's3cret-flags -O2 -g')
+        self.assertEqual(m.getsubenvironment(m.variables)['TOKEN'], 's3cret-token')
+
+class MtimeCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def runTest(self):
+        fscache = pymake.fscache
+        path = os.path.join(self.dir, 'file')
+        issued = fscache.mtimesissued
+
+        self.assertEqual(fscache.getmtime(path), None)
+        open(path, 'w').close()
+        fscache.clear()
+        self.assertEqual(fscache.getmtime(path), None)
+        self.assertEqual(fscache.mtimesissued, issued + 1)
+
+        served = fscache.mtimesserved
+        fscache.invalidate(os.path.join(self.dir, '.', 'file'))
+        self.assertEqual(fscache.getmtime(path), os.stat(path).st_mtime)
+        self.assertEqual(fscache.getmtime(path + '/'), os.stat(path).st_mtime)
+        self.assertEqual(fscache.mtimesissued, issued + 2)
+        self.assertEqual(fscache.mtimesserved, served + 1)
+
+class ScanDirsTest(MtimeCacheTest):
+    def runTest(self):
+        fscache = pymake.fscache
+        open(os.path.join(self.dir, 'exists'), 'w').close()
+
+        fscache.scandirs = True
+        try:
+            issued = fscache.mtimesissued
+            for i in xrange(10):
+                self.assertEqual(fscache.getmtime(os.path.join(self.dir, 'missing%i' % i)), None)
+            self.assertEqual(fscache.getmtime(os.path.join(self.dir, 'nodir', 'missing')), None)
+            self.assertEqual(fscache.mtimesissued, issued)
+
+            path = os.path.join(self.dir, 'exists')
+            self.assertEqual(fscache.getmtime(path), os.stat(path).st_mtime)
+            self.assertEqual(fscache.mtimesissued, issued + 1)
+        finally:
+            fscache.scandirs = False
+
+class BuildDBCompactTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def lines(self):
+        return len(open(self.path).readlines())
+
+    def runTest(self):
+        if pymake.builddb.fcntl is None:
+            return
+
+        self.path = os.path.join(self.dir, 'state.db')
+        fd = open(self.path, 'w')
+        for i in xrange(2000):
+            fd.write('["/t", {"duration": %i}]\n' % i)
+        fd.close()
+
+        # Not compacted while another make has it open
+        other = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        pymake.builddb.fcntl.flock(other, pymake.builddb.fcntl.LOCK_SH)
+        db = pymake.builddb.BuildDB(self.path)
+        self.assertEqual(self.lines(), 2000)
+        self.assertEqual(db.get('/t'), {'duration': 1999})
+        os.close(db._fd)
+        os.close(other)
+
+        db = pymake.builddb.BuildDB(self.path)
+        self.assertEqual(self.lines(), 1)
+        db.record('/u', duration=1)
+        self.assertEqual(self.lines(), 2)
+        self.assertEqual(pymake.builddb.BuildDB(self.path).get('/t'), {'duration': 1999})
+
+class InotifyTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def runTest(self):
+        try:
+            i = pymake.inotify.Inotify()
+        except OSError:
+            return
+
+        try:
+            self.assertTrue(i.watch(self.dir))
+            open(os.path.join(self.dir, 'file'), 'w').close()
+            self.assertEqual(i.read(1), set([os.path.join(self.dir, 'file')]))
+
+            # Events on the directory itself name the directory
+            os.chmod(self.dir, 0700)
+            self.assertEqual(i.read(1), set([self.dir]))
+        finally:
+            i.close()
+
+class OutputCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def runTest(self):
+        cache = pymake.buildcache.OutputCache(os.path.join(self.dir, 'cache'), 35)
+        src = os.path.join(self.dir, 'src')
+        dest = os.path.join(self.dir, 'dest')
+
+        keys = ['%02x' % i * 20 for i in xrange(3)]
+        for i, key in enumerate(keys):
+            open(src, 'w').write('%09i\n' % i)
+            cache.store(key, src)
+            os.utime(cache._entrypath(key), (i, i))
+        self.assertFalse(cache.restore('ff' * 20, dest))
+
+        # Restoring an entry makes it the most recently used
+        self.assertTrue(cache.restore(keys[0], dest))
+        self.assertEqual(open(dest).read(), '000000000\n')
+
+        open(src, 'w').write('x' * 10)
+        cache.store('ee' * 20, src)
+        self.assertEqual((cache.hits, cache.misses, cache.stores), (1, 4, 4))
+
+        # Only files are stored, or counted as misses
+        cache.store('dd' * 20, self.dir)
+        self.assertEqual((cache.misses, cache.stores), (4, 4))
+        self.assertTrue(os.path.exists(cache._entrypath(keys[0])))
+        self.assertFalse(os.path.exists(cache._entrypath(keys[1])))
+
 class LRUTest(unittest.TestCase):
     # getkey, expected, funccount, debugitems
     expected = (
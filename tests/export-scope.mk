@@ -0,0 +1,27 @@
+# Exported values are resolved in the scope of each rule.
+
+BASE = base
+export PLAIN = plain
+export REF = $(BASE)-ref
+export TARGETVAR = $@
+export CALL = $(subst a,o,$(BASE))
+
+all: one two
+	test "$$PLAIN" = "plain"
+	test "$$REF" = "base-ref"
+	test "$$TARGETVAR" = "all"
+	test "$$CALL" = "bose"
+	@echo TEST-PASS
+
+one: BASE = first
+one:
+	test "$$PLAIN" = "plain"
+	test "$$REF" = "first-ref"
+	test "$$TARGETVAR" = "one"
+	test "$$CALL" = "first"
+
+two: PLAIN = override
+two:
+	test "$$PLAIN" = "override"
+	test "$$REF" = "base-ref"
+	test "$$TARGETVAR" = "two"
@@ -0,0 +1,7 @@
+# -n prints the commands of a rule with hundreds of lines, one after another
+
+all:
+	{ echo 'long:'; seq 600 | sed 's/^/	echo line/'; } > long.mk
+	$(MAKE) -n -f long.mk long > long.log
+	test `grep -c 'echo line' long.log` -eq 600
+	@echo TEST-PASS
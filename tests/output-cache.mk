@@ -0,0 +1,39 @@
+#T gmake skip
+#T commandline: ['--output-cache=cache', '--state-db=cache.db']
+#T grep-for: "output cache: 1 hits, 2 misses, 2 stored"
+
+# With --output-cache, a target listed in .PYMAKE_CACHEABLE whose commands and prerequisites
+# match an earlier build is copied from the cache instead of being remade.
+
+CONTENT = one
+
+all:
+	$(MAKE) -f $(TESTPATH)/output-cache.mk out
+	rm out
+	$(MAKE) -f $(TESTPATH)/output-cache.mk out
+	test "`cat out`" = "one"
+	$(MAKE) -f $(TESTPATH)/output-cache.mk out CONTENT=two
+	test "`cat out`" = "two"
+	test `wc -l < log` -eq 2
+	mkdir subdir
+	$(MAKE) -f $(TESTPATH)/output-cache.mk dirout nofile
+	@echo TEST-PASS
+
+.PYMAKE_CACHEABLE: out dirout nofile
+
+src: FORCE
+	echo $(CONTENT) > $@
+
+FORCE:
+
+out: src
+	cat src > $@
+	echo built >> log
+
+# Directories have no contents to hash, so targets which depend on one aren't cached
+dirout: subdir
+	touch $@
+
+# Targets which don't make a file aren't stored, or counted as misses
+nofile:
+	@echo nofile
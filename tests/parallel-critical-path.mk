@@ -0,0 +1,16 @@
+#T gmake skip
+#T commandline: ['-j2']
+
+# The job at the start of the longest chain (gen -> link -> all) is started before
+# independent jobs that were queued before it.
+
+all: a b c link
+	test "$$(head -n 2 log | grep -c gen)" = "1"
+	@echo TEST-PASS
+
+a b c gen:
+	echo $@ >> log
+	sleep 1
+
+link: gen
+	echo $@ >> log
@@ -271,6 +271,44 @@ class VariableTest(TestBase):
             else:
                 self.assertEqual(val.resolvestr(m, m.variables), v, 'variable named %s' % k)
 
+class AppendTest(TestBase):
+    testdata = """
+    REC = first
+    REC += $(LATE)
+    REC += $$(escaped)
+    SIMPLE := first
+    SIMPLE += $(LATE)
+    SPLIT = a
+    SPLIT += $(subst x,y,
+    SPLIT += xx)
+    DOLLAR = b$
+    DOLLAR += c
+    LATE = late
+    all: REC += target
+    """
+    expected = {'REC': 'first late $(escaped)',
+                'SIMPLE': 'first ',
+                'SPLIT': 'a  yy',
+                'DOLLAR': 'bc'}
+
+    def runTest(self):
+        stmts = pymake.parser.parsestring(self.testdata, 'AppendTest')
+
+        m = pymake.data.Makefile()
+        stmts.execute(m)
+        for k, v in self.expected.iteritems():
+            flavor, source, val = m.variables.get(k)
+            self.assertEqual(val.resolvestr(m, m.variables), v, 'variable named %s' % k)
+
+        flavor, source, val = m.variables.get('REC', expand=False)
+        self.assertEqual(val, 'first $(LATE) $$(escaped)', 'unexpanded REC')
+
+        tvariables = m.gettarget('all').variables
+        flavor, source, val = tvariables.get('REC')
+        self.assertEqual(val.resolvestr(m, tvariables), 'first late $(escaped) target', 'target-specific REC')
+        flavor, source, val2 = tvariables.get('REC')
+        self.assertTrue(val is val2, 'appended expansion is reused')
+
 class SimpleRuleTest(TestBase):
     testdata = """
     VAR = value
@@ -0,0 +1,24 @@
+# Pattern-specific variables, including appends, apply below target-specific variables and
+# above global ones.
+
+CFLAGS = -O
+%.o: CFLAGS += -g
+a.o: CFLAGS += -a
+lib%.o: CFLAGS += -fpic
+
+X = global
+%.o: X = pattern
+lib%.o: X = libpattern
+a.o: Y = target
+
+all: a.o b.o libc.o
+	@echo TEST-PASS
+
+a.o:
+	test "$(CFLAGS) $(X) $(Y)" = "-O -g -a pattern target"
+
+b.o:
+	test "$(CFLAGS) $(X) $(Y)" = "-O -g pattern "
+
+libc.o:
+	test "$(CFLAGS) $(X)" = "-O -g -fpic libpattern"
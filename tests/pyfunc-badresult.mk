@@ -0,0 +1,12 @@
+#T gmake skip
+#T returncode: 2
+#T grep-for: "Python function 'numbers' failed"
+# A Python function returning a list which isn't all strings is an error naming the function.
+
+.PYMAKE_FUNCTIONS = pyfunc
+PYCOMMANDPATH = $(TESTPATH)
+
+LENGTHS := $(numbers a bc)
+
+all:
+	@echo TEST-FAIL
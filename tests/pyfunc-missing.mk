@@ -0,0 +1,12 @@
+#T gmake skip
+#T returncode: 2
+#T grep-for: "Module 'pyfuncmissing' in .PYMAKE_FUNCTIONS lists 'missing' in __all__, but doesn't define it"
+# A module registered with .PYMAKE_FUNCTIONS must define every name in its __all__.
+
+.PYMAKE_FUNCTIONS = pyfuncmissing
+PYCOMMANDPATH = $(TESTPATH)
+
+VALUE := $(present x)
+
+all:
+	@echo TEST-FAIL
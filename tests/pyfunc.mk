@@ -0,0 +1,21 @@
+#T gmake skip
+# Python functions registered with .PYMAKE_FUNCTIONS can be called like built-in functions.
+
+.PYMAKE_FUNCTIONS = pyfunc
+PYCOMMANDPATH = $(TESTPATH)
+
+NAME = world
+LIST = x,y
+
+UPPER := $(upper hello $(NAME))
+COUNT := $(count a,$(LIST),(c,d),$(subst a,b,a,b))
+PAIRS := $(pairs a b c,1 2 3)
+HIDDEN := $(notexported x)
+
+all:
+	test "$(UPPER)" = "HELLO WORLD"
+	test "$(COUNT)" = "4"
+	test "$(PAIRS)" = "a=1 b=2 c=3"
+	test "$(HIDDEN)" = ""
+	test "$(upper $@)" = "ALL"
+	@echo TEST-PASS
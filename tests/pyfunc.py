@@ -0,0 +1,16 @@
+__all__ = ['upper', 'count', 'pairs', 'numbers']
+
+def upper(s):
+  return s.upper()
+
+def count(*args):
+  return len(args)
+
+def pairs(a, b):
+  return ['%s=%s' % p for p in zip(a.split(), b.split())]
+
+def numbers(s):
+  return [len(w) for w in s.split()]
+
+def notexported(s):
+  return 'oops'
@@ -0,0 +1,4 @@
+__all__ = ['present', 'missing']
+
+def present(s):
+  return s
@@ -0,0 +1,19 @@
+# make -q runs no commands, and exits with status 1 if any target is out of date, 0 if all
+# are up to date, and 2 on errors.
+
+all:
+	touch up
+	$(MAKE) -q -f $(TESTPATH)/question.mk up
+	$(MAKE) -q -f $(TESTPATH)/question.mk stale; test $$? = 1
+	$(MAKE) -q -f $(TESTPATH)/question.mk broken; test $$? = 2
+	test ! -f stale
+	@echo TEST-PASS
+
+up:
+	touch $@
+
+stale: up
+	touch $@
+
+broken: missing
+	touch $@
@@ -0,0 +1,19 @@
+#T gmake skip
+
+# A glob in a rule's prerequisites is checked like $(wildcard) before a snapshot is used.
+
+SNAPMAKE = $(MAKE) -f $(TESTPATH)/snapshot-glob.mk --snapshot=snapshot.pickle -d
+
+all:
+	touch glob-a.in
+	$(SNAPMAKE) built > first.log 2>&1
+	$(SNAPMAKE) built > second.log 2>&1
+	touch glob-b.in
+	$(SNAPMAKE) built > third.log 2>&1
+	grep -q 'Using makefile snapshot' second.log && \
+	! grep -q 'Using makefile snapshot' third.log && \
+	grep -q 'built glob-a.in glob-b.in' third.log && \
+	echo TEST-PASS
+
+built: glob-*.in
+	@echo built $^
@@ -0,0 +1,33 @@
+#T gmake skip
+
+# With --snapshot, a make whose makefiles, command line, environment and $(wildcard) and
+# $(shell) results are unchanged loads the parsed makefile from the snapshot instead of parsing.
+
+SNAPMAKE = $(MAKE) -f $(TESTPATH)/snapshot.mk --snapshot=snapshot.pickle -d
+
+SRCS := $(wildcard snap-*.in)
+HOST := $(shell cat snap-host)
+
+all:
+	echo h1 > snap-host
+	touch snap-a.in
+	$(SNAPMAKE) built > first.log 2>&1
+	$(SNAPMAKE) built > second.log 2>&1
+	touch snap-b.in
+	$(SNAPMAKE) built > third.log 2>&1
+	echo h2 > snap-host
+	$(SNAPMAKE) built > fourth.log 2>&1
+	! grep -q 'Using makefile snapshot' first.log && \
+	grep -q 'Using makefile snapshot' second.log && \
+	! grep -q 'Using makefile snapshot' third.log && \
+	! grep -q 'Using makefile snapshot' fourth.log && \
+	grep -q 'built snap-a.out on h1' second.log && \
+	grep -q 'built snap-a.out snap-b.out on h1' third.log && \
+	grep -q 'built snap-a.out snap-b.out on h2' fourth.log && \
+	echo TEST-PASS
+
+built: $(SRCS:.in=.out)
+	@echo built $^ on $(HOST)
+
+%.out: %.in
+	cp $< $@
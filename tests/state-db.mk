@@ -0,0 +1,36 @@
+#T gmake skip
+#T commandline: ['--state-db=state.db', '--slowest=2']
+
+# Targets remade with --state-db are recorded in the database, including those remade by
+# submakes, which get the database from MAKEFLAGS. Durations don't include time spent waiting
+# for a job slot.
+
+all: slow fast
+	grep -q '/slow", {.*"status": 0' state.db
+	grep -q '/fast", {' state.db
+	grep -q '/failed", {.*"status": 3' state.db
+	$(MAKE) -f $(TESTPATH)/state-db.mk submade
+	grep -q '/submade", {' state.db
+	$(MAKE) -j2 -f $(TESTPATH)/state-db.mk queued
+	$(firstword $(MAKE)) -c "import json; r = {}; [r.setdefault(t, {}).update(f) for t, f in map(json.loads, open('state.db'))]; assert max(v['duration'] for t, v in r.items() if t.endswith('.q')) < 1.8"
+	MAKEFLAGS= $(MAKE) --slowest=1 -f $(TESTPATH)/state-db.mk submade > slowest.log 2>&1; test $$? = 2
+	grep -q 'requires --state-db' slowest.log
+	@echo TEST-PASS
+
+slow:
+	sleep 1
+
+fast:
+	-exit 3
+	-$(MAKE) -f $(TESTPATH)/state-db.mk failed
+
+failed:
+	exit 3
+
+submade:
+	true
+
+queued: 1.q 2.q 3.q
+
+%.q:
+	sleep 1
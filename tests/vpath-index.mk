@@ -0,0 +1,13 @@
+# VPATH lookups see files in the VPATH directories, including those created by remaking
+# targets in them.
+
+$(shell mkdir -p dir1 dir2 && touch dir2/foo.c dir1/bar.c dir2/bar.c)
+
+VPATH = dir1 dir2
+
+all: foo.c bar.c dir1/gen.h gen.h
+	test "$+" = "dir2/foo.c dir1/bar.c dir1/gen.h dir1/gen.h"
+	@echo TEST-PASS
+
+dir1/gen.h:
+	touch $@
@@ -0,0 +1,21 @@
+#T gmake skip
+
+# With --watch, make.py builds, then waits for files to change and remakes the targets which
+# depend on them.
+
+WATCHMAKE = $(MAKE) --watch -f $(TESTPATH)/watch.mk output
+
+all:
+	echo one > input; \
+	$(WATCHMAKE) > watch.log 2>&1 & \
+	pid=$$!; trap "kill $$pid" EXIT; \
+	for i in 1 2 3 4 5 6 7 8 9 10; do grep -q 'watching for changes' watch.log && break; sleep 0.5; done; \
+	test "`cat output`" = "one" && \
+	echo two > input && \
+	for i in 1 2 3 4 5 6 7 8 9 10; do test "`grep -c 'watching for changes' watch.log`" = 2 && break; sleep 0.5; done; \
+	test "`cat output`" = "two" && \
+	grep -q 'targets affected by changes' watch.log && \
+	echo TEST-PASS
+
+output: input
+	cat input > $@
@@ -0,0 +1,22 @@
+#T gmake skip
+# Directory listings are cached, but must not go stale when targets are
+# remade or when commands create and delete files.
+
+$(shell touch a.cached)
+
+FIRST := $(wildcard *.cached)
+
+all: b.cached
+	test "$(FIRST)" = "a.cached"
+	test "$(wildcard *.cached)" = "a.cached b.cached"
+	mkdir cachedir
+	touch cachedir/c.cached
+	$(RM) *.cached
+	test ! -f b.cached
+	$(RM) cachedir/*.cached
+	test ! -f cachedir/c.cached
+	@echo TEST-PASS
+
+b.cached:
+	test "$(wildcard *.cached)" = "a.cached"
+	touch $@